@@ -0,0 +1,114 @@
+"""
+Chat log insert latency while long reads are running.
+
+Messages are written one every WRITE_INTERVAL seconds while READERS tasks
+run full-scan queries in a loop, either on the writer connection or on
+the read pool. Latency is measured from write() to commit of the batch.
+
+  PYTHONPATH=. python benchmarks/db_reads.py [rows]
+"""
+import os
+import sys
+import time
+import asyncio
+import sqlite3
+import tempfile
+
+from billfred.database import Database
+
+ROWS = 400000
+MESSAGES = 400
+WRITE_INTERVAL = 0.005
+READERS = 2
+OPTIONS = {'flush_interval': '50'}
+QUERY = r"SELECT count(*) FROM chat_log WHERE message LIKE '%needle%'"
+
+
+def fill(path, rows):
+    """Create database with rows of chat log."""
+    async def create():
+        db = Database(path, OPTIONS)
+        await db.init()
+        await db.close()
+    asyncio.run(create())
+    conn = sqlite3.connect(path)
+    conn.executemany(
+        r'INSERT INTO chat_log (time, jid, nick, message) '
+        'VALUES (?, ?, ?, ?)',
+        ((i, 'room@conference', 'nick{}'.format(i % 50),
+          'message number {} with some words in it'.format(i))
+         for i in range(rows))
+    )
+    conn.commit()
+    conn.close()
+
+
+def percentile(values, p):
+    """Get p-th percentile of sorted values."""
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+async def run(path, mode):
+    """Write messages with reads of mode running, return latencies."""
+    db = Database(path, OPTIONS)
+    await db.init()
+    sent = {}
+    latencies = []
+    flush = db.flush
+
+    async def timed_flush(batch):
+        await flush(batch)
+        now = time.perf_counter()
+        for item in batch:
+            latencies.append(now - sent.pop(item[3]))
+    db.flush = timed_flush
+
+    stop = False
+
+    async def read_loop():
+        while not stop:
+            if mode == 'writer':
+                async with db.write_lock:
+                    async with db.db.execute(QUERY) as cursor:
+                        await cursor.fetchall()
+            else:
+                async with db.reader() as conn:
+                    async with conn.execute(QUERY) as cursor:
+                        await cursor.fetchall()
+
+    readers = []
+    if mode != 'none':
+        readers = [asyncio.create_task(read_loop()) for _ in range(READERS)]
+        await asyncio.sleep(0.1)
+    for i in range(MESSAGES):
+        body = 'benchmark {} {}'.format(mode, i)
+        sent[body] = time.perf_counter()
+        await db.write({'from': 'room@conference', 'mucnick': 'bench',
+                        'body': body})
+        await asyncio.sleep(WRITE_INTERVAL)
+    while sent:
+        await asyncio.sleep(0.01)
+    stop = True
+    await asyncio.gather(*readers)
+    await db.close()
+    return sorted(latencies)
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else ROWS
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.db')
+        fill(path, rows)
+        print('{} messages, one every {:.0f} ms, {} rows in log'.format(
+            MESSAGES, WRITE_INTERVAL * 1000, rows))
+        for mode, name in (('none', 'no reads'),
+                           ('writer', 'reads on writer conn'),
+                           ('pool', 'reads on read pool')):
+            latencies = asyncio.run(run(path, mode))
+            print('{:22} p50 {:6.1f} ms  p99 {:6.1f} ms'.format(
+                name + ':', percentile(latencies, 50) * 1000,
+                percentile(latencies, 99) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""
+Eliza answer latency and throughput before and after precompiled rules.
+
+Old path matches raw psychobabble patterns one by one with re.match and
+answers in 5-thread pool. New path uses compiled RULES_RE and answers
+inline in event loop.
+
+  PYTHONPATH=. python benchmarks/eliza.py
+"""
+import re
+import time
+import random
+import asyncio
+import configparser
+from concurrent.futures import ThreadPoolExecutor
+
+from billfred.eliza import Eliza, analyze, psychobabble, reflections
+
+MESSAGES = [
+    'I need a hug',
+    'Why dont you go?',
+    'I am sad and my dog is you',
+    'hello there',
+    'what is it',
+    'the computer broke me',
+    'Is it raining?',
+    'My mother was here!!',
+    'some random chatter about nothing in particular and you',
+    'I feel great about me',
+]
+CALLS = 20000
+ASKS = 5000
+
+
+def old_reflect(fragment):
+    tokens = fragment.lower().split()
+    for i, token in enumerate(tokens):
+        if token in reflections:
+            tokens[i] = reflections[token]
+    return ' '.join(tokens)
+
+
+def old_analyze(statement):
+    """analyze before rules were precompiled."""
+    for pattern, responses in psychobabble:
+        match_ = re.match(pattern, statement.rstrip(".!"))
+        if match_:
+            response = random.choice(responses)
+            return response.format(*[old_reflect(g)
+                                     for g in match_.groups()])
+
+
+class Client:
+    """Bot stand-in that counts answers."""
+
+    def __init__(self):
+        self.config = configparser.ConfigParser()
+        self.sent = 0
+
+    def send_bot_message(self, message):
+        self.sent += 1
+
+
+async def old_ask(pool, client, message):
+    """ask_eliza before answers were found inline."""
+    loop = asyncio.get_running_loop()
+    answer = await loop.run_in_executor(pool, old_analyze, message)
+    if answer:
+        client.send_bot_message({'to': 'room', 'message': answer})
+
+
+async def asks(name, ask):
+    """Measure latency of ask calls."""
+    latencies = []
+    for i in range(ASKS):
+        start = time.perf_counter()
+        await ask(MESSAGES[i % len(MESSAGES)])
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    print('ask {:22} p50 {:6.1f} us, p99 {:6.1f} us'.format(
+        name + ':', latencies[ASKS // 2] * 1e6,
+        latencies[int(ASKS * 0.99)] * 1e6))
+
+
+async def main():
+    client = Client()
+    pool = ThreadPoolExecutor(max_workers=5)
+    await asks('before (thread pool)',
+               lambda message: old_ask(pool, client, message))
+    eliza = Eliza(client)
+    await asks('after (inline)',
+               lambda message: eliza.ask('room', message))
+    pool.shutdown()
+
+
+def calls():
+    """Measure analyze throughput."""
+    for name, func in (('before', old_analyze), ('after', analyze)):
+        start = time.perf_counter()
+        for i in range(CALLS):
+            func(MESSAGES[i % len(MESSAGES)])
+        elapsed = time.perf_counter() - start
+        print('analyze {:6} {:5.1f} us/msg, {:7.0f} msg/s'.format(
+            name + ':', elapsed / CALLS * 1e6, CALLS / elapsed))
+
+
+if __name__ == '__main__':
+    calls()
+    asyncio.run(main())
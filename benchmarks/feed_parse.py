@@ -0,0 +1,96 @@
+"""
+Event loop latency while a burst of big feeds is parsed in thread and in
+process feed pool.
+
+Ticker task sleeps TICK seconds in a loop and records how late it wakes
+up while PARSES copies of Atom feed with HTML content are parsed.
+
+  PYTHONPATH=. python benchmarks/feed_parse.py [entries]
+"""
+import sys
+import time
+import asyncio
+
+from billfred.feeds import process_feed, create_pool
+
+ENTRIES = 2000
+PARSES = 8
+WORKERS = 4
+TICK = 0.005
+STATE = {
+    'last_date': None,
+    'etag': None,
+    'modified': None,
+    'ordered': False,
+    'seen': set(),
+}
+HEADERS = {'content-type': 'application/atom+xml'}
+
+
+def atom(entries):
+    """Build Atom feed with entries."""
+    items = ''.join(
+        '<entry><id>urn:entry:{0}</id><title>Entry {0}</title>'
+        '<link href="http://example.com/{0}"/>'
+        '<updated>2024-01-01T00:00:00Z</updated>'
+        '<content type="html">{1}</content></entry>'.format(
+            i, '&lt;p&gt;Some &lt;b&gt;html&lt;/b&gt; text&lt;/p&gt;' * 20)
+        for i in range(entries)
+    )
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>'
+        '<feed xmlns="http://www.w3.org/2005/Atom"><title>Bench</title>'
+        '<id>urn:bench</id><updated>2024-01-01T00:00:00Z</updated>'
+        '{}</feed>'.format(items)
+    ).encode()
+
+
+async def run(mode, data):
+    """Parse burst in pool of mode and measure loop lag."""
+    pool = create_pool({'parser': mode, 'workers': str(WORKERS)})
+    loop = asyncio.get_running_loop()
+    # Start workers before measuring
+    await asyncio.gather(*[
+        loop.run_in_executor(pool, process_feed, 'B', atom(1), HEADERS,
+                             True, STATE)
+        for _ in range(WORKERS)
+    ])
+    lags = []
+    running = True
+
+    async def ticker():
+        while running:
+            start = time.perf_counter()
+            await asyncio.sleep(TICK)
+            lags.append(time.perf_counter() - start - TICK)
+
+    task = asyncio.create_task(ticker())
+    start = time.perf_counter()
+    results = await asyncio.gather(*[
+        loop.run_in_executor(pool, process_feed, 'B', data, HEADERS,
+                             True, STATE)
+        for _ in range(PARSES)
+    ])
+    elapsed = time.perf_counter() - start
+    running = False
+    await task
+    pool.shutdown()
+    lags.sort()
+    print('{:8} {:.1f} s, {} entries, loop lag p50 {:.1f} ms, '
+          'p99 {:.1f} ms, max {:.1f} ms'.format(
+              mode, elapsed, len(results[0][0]),
+              lags[len(lags) // 2] * 1000,
+              lags[int(len(lags) * 0.99)] * 1000, lags[-1] * 1000))
+
+
+def main():
+    entries = int(sys.argv[1]) if len(sys.argv) > 1 else ENTRIES
+    data = atom(entries)
+    print('Burst of {} parses of {} KB feed on {} workers'.format(
+        PARSES, len(data) // 1024, WORKERS))
+    for mode in ('thread', 'process'):
+        asyncio.run(run(mode, data))
+
+
+if __name__ == '__main__':
+    main()
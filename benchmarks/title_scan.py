@@ -0,0 +1,112 @@
+"""
+Title extraction from saved pages: TitleScanner against the old
+HTMLParser path with per-chunk charset detection.
+
+Pages are read in chunks that grow from CHUNK_SIZE to MAX_CHUNK_SIZE like
+Links.extract_title does. Synthetic pages from benchmarks/pages are used
+by default, pass directory with other saved pages to use them instead.
+
+  PYTHONPATH=. python benchmarks/title_scan.py [pages_dir]
+"""
+import os
+import re
+import sys
+import glob
+import time
+import codecs
+from html.parser import HTMLParser
+
+from charset_normalizer import detect
+
+from billfred.links import Links, TitleScanner
+
+PAGES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pages')
+ROUNDS = 50
+HEAD_END_RE = re.compile(rb'</head|<body', re.I)
+
+
+class TitleParser(HTMLParser):
+    """Title parser that was used before TitleScanner."""
+
+    def __init__(self):
+        super().__init__()
+        self.title = None
+        self.in_title = False
+        self.title_buf = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'title':
+            self.in_title = True
+
+    def handle_endtag(self, tag):
+        if tag == 'title':
+            self.in_title = False
+            self.title = ''.join(self.title_buf)
+
+    def handle_data(self, data):
+        if self.in_title:
+            self.title_buf.append(data)
+
+
+def chunks(data):
+    """Split page into growing chunks."""
+    pos = 0
+    size = Links.CHUNK_SIZE
+    while pos < len(data):
+        yield data[pos:pos + size]
+        pos += size
+        size = min(size * 2, Links.MAX_CHUNK_SIZE)
+
+
+def parser_title(data):
+    """Old path: detect charset of chunks, decode them and parse."""
+    parser = TitleParser()
+    decoder = None
+    for chunk in chunks(data):
+        if decoder is None:
+            encoding = detect(chunk)['encoding']
+            if encoding is None:
+                return None
+            decoder = codecs.getincrementaldecoder(encoding)('ignore')
+        parser.feed(decoder.decode(chunk))
+        if parser.title is not None:
+            return parser.title.strip()
+        if HEAD_END_RE.search(chunk):
+            return None
+    return None
+
+
+def scanner_title(data):
+    """New path: scan raw bytes, decode only title."""
+    scanner = TitleScanner()
+    for chunk in chunks(data):
+        scanner.feed(chunk)
+        if scanner.done:
+            break
+    return scanner.get_title()
+
+
+def main():
+    pages_dir = sys.argv[1] if len(sys.argv) > 1 else PAGES_DIR
+    pages = []
+    for path in sorted(glob.glob(os.path.join(pages_dir, '*.htm*'))):
+        with open(path, 'rb') as f:
+            pages.append((os.path.basename(path), f.read()))
+    if not pages:
+        sys.exit('No pages in {}'.format(pages_dir))
+    print('{} pages, {} KB'.format(
+        len(pages), sum(len(data) for _, data in pages) // 1024))
+    for name, func in (('HTMLParser + detect', parser_title),
+                       ('TitleScanner', scanner_title)):
+        start = time.perf_counter()
+        for _ in range(ROUNDS):
+            titles = [func(data) for _, data in pages]
+        elapsed = (time.perf_counter() - start) / (ROUNDS * len(pages))
+        print('{:20} {:6.3f} ms/page {:8.0f} pages/s'.format(
+            name, elapsed * 1000, 1 / elapsed))
+        for (page, _), title in zip(pages, titles):
+            print('  {:26} {!r}'.format(page, title))
+
+
+if __name__ == '__main__':
+    main()
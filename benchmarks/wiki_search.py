@@ -0,0 +1,147 @@
+"""
+Wiki answer latency against local stub API with fixed response latency.
+
+Compares old snippet search (list=search), snippets with one extracts
+request per article and generator=search with extracts that Wiki.fetch
+uses. Then runs concurrent queries to two languages.
+
+  PYTHONPATH=. python benchmarks/wiki_search.py
+"""
+import os
+import time
+import asyncio
+import tempfile
+import statistics
+import configparser
+
+from aiohttp import web
+
+from billfred.database import Database
+from billfred.httpclient import HttpClient
+from billfred.wiki import Wiki
+
+LATENCY = 0.08
+ANSWERS = 30
+PORT = 8765
+stats = {'requests': 0}
+
+
+class Client:
+    """Bot stand-in for Wiki."""
+
+    def __init__(self, path):
+        self.config = configparser.ConfigParser()
+        self.config.read_dict({'wiki': {
+            'base_url': 'http://127.0.0.1:{}/{{lang}}'.format(PORT),
+        }})
+        self.user_agent = 'billfred-benchmark'
+        self.db = Database(path)
+        self.http = HttpClient(self)
+
+    def send_bot_message(self, message):
+        pass
+
+
+async def api(request):
+    """Stub of MediaWiki API for search and extracts queries."""
+    stats['requests'] += 1
+    await asyncio.sleep(LATENCY)
+    query = request.query
+    if query.get('list') == 'search':
+        return web.json_response({'query': {'search': [
+            {'title': 'Article {}'.format(i), 'snippet': 'snippet'}
+            for i in range(Wiki.ARTICLES_LIMIT)
+        ]}})
+    if query.get('generator') == 'search':
+        return web.json_response({'query': {'pages': [{
+            'title': 'Article {}'.format(i),
+            'index': i,
+            'extract': 'Intro of article. ' * 30,
+            'fullurl': 'http://127.0.0.1/wiki/Article_{}'.format(i),
+        } for i in range(Wiki.ARTICLES_LIMIT)]}})
+    return web.json_response({'query': {'pages': [
+        {'title': query.get('titles'), 'extract': 'Intro of article.'}
+    ]}})
+
+
+async def get_json(wiki, query, lang='en'):
+    async with wiki.client.http.get(wiki.api_url(query, lang)) as r:
+        return await r.json()
+
+
+async def snippets(wiki, text):
+    """Old path: one list=search request."""
+    return await get_json(wiki, {
+        'action': 'query',
+        'list': 'search',
+        'format': 'json',
+        'srsearch': text,
+        'srnamespace': 0,
+        'srprop': 'snippet',
+        'srlimit': Wiki.ARTICLES_LIMIT,
+    })
+
+
+async def snippets_extracts(wiki, text):
+    """Snippets and one extracts request per found article."""
+    response = await snippets(wiki, text)
+    for item in response['query']['search']:
+        await get_json(wiki, {
+            'action': 'query',
+            'format': 'json',
+            'formatversion': 2,
+            'prop': 'extracts',
+            'exintro': 1,
+            'explaintext': 1,
+            'titles': item['title'],
+        })
+
+
+async def generator(wiki, text):
+    """New path: generator=search with extracts."""
+    return await wiki.fetch(text, text, 'en', False)
+
+
+async def main():
+    app = web.Application()
+    app.router.add_get('/{lang}/w/api.php', api)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', PORT).start()
+    with tempfile.TemporaryDirectory() as tmp:
+        client = Client(os.path.join(tmp, 'bench.db'))
+        await client.db.init()
+        wiki = Wiki(client)
+        print('Stub API latency {:.0f} ms, {} sequential answers'.format(
+            LATENCY * 1000, ANSWERS))
+        for name, func in (('snippet search (old)', snippets),
+                           ('snippets + extracts (N+1)', snippets_extracts),
+                           ('generator=search (new)', generator)):
+            requests = stats['requests']
+            times = []
+            for i in range(ANSWERS):
+                start = time.perf_counter()
+                await func(wiki, '{} {}'.format(name, i))
+                times.append(time.perf_counter() - start)
+            times.sort()
+            print('{:27} p50 {:4.0f} ms, p95 {:4.0f} ms, '
+                  '{:.0f} requests/answer'.format(
+                      name, statistics.median(times) * 1000,
+                      times[int(len(times) * 0.95)] * 1000,
+                      (stats['requests'] - requests) / ANSWERS))
+        start = time.perf_counter()
+        await asyncio.gather(
+            *[wiki.fetch('en{}'.format(i), 'en{}'.format(i), 'en', False)
+              for i in range(6)],
+            *[wiki.fetch('de{}'.format(i), 'de{}'.format(i), 'de', False)
+              for i in range(2)],
+        )
+        print('6 en + 2 de concurrent, lang_concurrency {}: {:.0f} ms'.format(
+            wiki.lang_concurrency, (time.perf_counter() - start) * 1000))
+        await client.http.close()
+        await client.db.close()
+    await runner.cleanup()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
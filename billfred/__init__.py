@@ -1,11 +1,10 @@
 import sys
+import time
 import logging
 import logging.config
 import argparse
 import configparser
 
-from billfred.billfred import Billfred
-
 
 logger = logging.getLogger(__name__)
 
@@ -18,9 +17,15 @@ def main():
         default='billfred.cfg',
         help='path to config file'
     )
+    parser.add_argument(
+        '--profile-startup',
+        action='store_true',
+        help='print import and initialization times after joining MUC'
+    )
     args = parser.parse_args()
+    timings = [] if args.profile_startup else None
 
-    # Load config file 
+    # Load config file
     config = configparser.ConfigParser()
     config.read(args.config)
 
@@ -35,7 +40,13 @@ def main():
         logger.error('Wrong account parameters, exiting')
         sys.exit('Config error')
 
-    xmpp = Billfred(config)
+    # Bot module is imported here, so export and index tools don't load it
+    start = time.perf_counter()
+    from billfred.billfred import Billfred
+    if timings is not None:
+        timings.append(('import', time.perf_counter() - start))
+
+    xmpp = Billfred(config, timings)
 
     # Connect to the XMPP server and start processing XMPP stanzas.
     try:
@@ -46,6 +57,7 @@ def main():
         xmpp.disconnect()
     except Exception:
         logger.exception('Error')
+    xmpp.shutdown()
     logger.info('Done')
 
 
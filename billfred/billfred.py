@@ -1,18 +1,30 @@
+import sys
+import time
 import slixmpp
 import logging
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
+import importlib
 from slixmpp.exceptions import XMPPError, IqError, IqTimeout
 
-from billfred.database import Database
-from billfred.links import Links
-from billfred.wiki import Wiki
-from billfred.eliza import ask_eliza
-from billfred.feeds import feed_checker
+from billfred.database import Database, database_options
+from billfred.outbox import Outbox, PRIORITY_REPLY
+from billfred.scheduler import Scheduler
 
 logger = logging.getLogger(__name__)
 
 BOT_VERSION = 0.2
+LOG_RESULTS_LIMIT = 5
+LOG_MESSAGE_LENGTH = 200
+# Subsystems are imported and created on first use: name -> module, class
+SUBSYSTEMS = {
+    'http': ('billfred.httpclient', 'HttpClient'),
+    'links': ('billfred.links', 'Links'),
+    'wiki': ('billfred.wiki', 'Wiki'),
+    'eliza': ('billfred.eliza', 'Eliza'),
+    'feeds': ('billfred.feeds', 'Feeds'),
+}
+# Subsystems are closed in this order, HTTP client goes last
+CLOSE_ORDER = ('feeds', 'links', 'wiki', 'eliza', 'http')
 
 HELP_TEXT = r'''Billfred bot, version: {}
 Writes chat log and displays URL title if available.
@@ -28,6 +40,13 @@ Bot commands:
             wikien QUERY -- search en wiki
             wiki:title QUERY -- search ru wiki in title
             wikies:title QUERY -- search es wiki in title
+  status -- show work queues and dropped jobs
+  log -- search chat log. Usage:
+          log(:id) QUERY
+            :id -- show messages older than message #id
+          Examples:
+            log QUERY -- latest messages with QUERY
+            log:1234 QUERY -- next page, older than #1234
   (any other text) -- ask Eliza
 '''.format(BOT_VERSION)
 
@@ -36,7 +55,7 @@ class Billfred(slixmpp.ClientXMPP):
     """Billfred chat bot."""
     reconnect_timeout = 10
 
-    def __init__(self, config):
+    def __init__(self, config, timings=None):
         self.config = config
         jid = config['account']['jid']
         password = config['account']['password']
@@ -44,19 +63,26 @@ class Billfred(slixmpp.ClientXMPP):
 
         self.room = config['account']['room']
         self.nick = config['account']['nick']
+        self.user_agent = 'Billfred/{}'.format(BOT_VERSION)
+        # Startup stages and their durations, printed if not None
+        self.timings = timings
+        self.startup = time.perf_counter()
 
         # Load modules
         self.register_plugin('xep_0045')  # Multi-User Chat
         self.register_plugin('xep_0199')  # XMPP Ping
 
-        # Initialize subsystems
-        db_path = '{}_chatlog.db'.format(self.room)
-        if 'database' in config and config['database'].get('database_path'):
-            db_path = config['database']['database_path']
-        self.db = Database(db_path)
-        self.links = Links(self)
-        self.wiki = Wiki(self)
-        self.eliza_pool = ThreadPoolExecutor(max_workers=5)
+        # Initialize subsystems, others are loaded when used
+        self.db = Database(*database_options(config))
+        self.outbox = Outbox(self)
+        self.scheduler = Scheduler(self)
+        self.subsystems = {}
+        self.links_enabled = not ('links' in config and
+                                  config['links'].getboolean('disabled',
+                                                             False))
+        self.feeds_enabled = any(s.startswith('rss_')
+                                 for s in config.sections())
+        self.profile('init', self.startup)
 
         self.add_event_handler("session_start", self.start)
         # Maybe move it to top level destructor?
@@ -64,40 +90,118 @@ class Billfred(slixmpp.ClientXMPP):
         self.add_event_handler("groupchat_message", self.muc_message)
         self.add_event_handler("send_bot_message", self.send_bot_message)
 
+    def profile(self, stage, start):
+        """Remember duration of startup stage."""
+        if self.timings is not None:
+            self.timings.append((stage, time.perf_counter() - start))
+
+    def subsystem(self, name):
+        """Get subsystem, import and create it on first use."""
+        instance = self.subsystems.get(name)
+        if instance is None:
+            start = time.perf_counter()
+            module_name, class_name = SUBSYSTEMS[name]
+            logger.info('Loading %s subsystem', name)
+            module = importlib.import_module(module_name)
+            instance = getattr(module, class_name)(self)
+            self.subsystems[name] = instance
+            self.profile('load {}'.format(name), start)
+        return instance
+
+    @property
+    def http(self):
+        """Shared HTTP client."""
+        return self.subsystem('http')
+
+    @property
+    def links(self):
+        """Link titles."""
+        return self.subsystem('links')
+
+    @property
+    def wiki(self):
+        """Wikipedia search."""
+        return self.subsystem('wiki')
+
+    @property
+    def eliza(self):
+        """Eliza responder."""
+        return self.subsystem('eliza')
+
+    @property
+    def feeds(self):
+        """Feed announcements."""
+        return self.subsystem('feeds')
+
     async def start(self, event):
         """Initialize async services and connect."""
+        start = time.perf_counter()
         await self.db.init()
-        self.init_feeds()
+        self.scheduler.start()
+        self.profile('database', start)
         try:
             await self.get_roster()
             self.send_presence()
             # FIXME password
             logger.info('Joining MUC')
+            start = time.perf_counter()
             await self.plugin['xep_0045'].join_muc_wait(self.room,
                                                         self.nick,
                                                         timeout=10)
+            self.profile('join', start)
             logger.info('Connected to %s as %s', self.room, self.nick)
         except XMPPError as e:
             logger.exception('Error on MUC join: %s', e)
             self.disconnect()
             return
+        # Enabled subsystems are loaded after join, so they don't delay it
+        if self.feeds_enabled:
+            self.feeds.start()
+        if self.links_enabled:
+            self.subsystem('links')
+        self.print_profile()
+
+    def print_profile(self):
+        """Print startup timings once."""
+        if not self.timings:
+            return
+        total = time.perf_counter() - self.startup
+        for stage, duration in self.timings:
+            print('{:>10.1f} ms  {}'.format(duration * 1000, stage),
+                  file=sys.stderr)
+        print('{:>10.1f} ms  total since init'.format(total * 1000),
+              file=sys.stderr)
+        self.timings = None
 
     async def stop(self, *args, **kwargs):
         """Stop all async services."""
         logger.info('Stopping service')
         try:
-            await self.links.close()
-            await self.wiki.close()
-            await self.db.close()
-            for task in self.feed_tasks:
-                task.cancel()
+            # Queued chat log writes are passed to database here
+            await self.scheduler.close()
+            await self.outbox.close()
+            for name in CLOSE_ORDER:
+                if name in self.subsystems:
+                    await self.subsystems[name].close()
             self.disconnect()
         except Exception:
             logger.exception('Error on stopping')
-        if not self.config['account'].getboolean('no_reconnect'):
-            logger.info('Reconnecting after %s seconds', self.reconnect_timeout)
-            await asyncio.sleep(self.reconnect_timeout)
-            self.connect()
+        # Always flush queued chat log messages
+        try:
+            await self.db.close()
+        except Exception:
+            logger.exception('Error on closing database')
+        if self.config['account'].getboolean('no_reconnect'):
+            self.shutdown()
+            return
+        logger.info('Reconnecting after %s seconds', self.reconnect_timeout)
+        await asyncio.sleep(self.reconnect_timeout)
+        self.connect()
+
+    def shutdown(self):
+        """Stop worker pools that are kept between reconnects."""
+        if 'feeds' in self.subsystems:
+            self.subsystems['feeds'].shutdown()
 
     async def log_exception(self, func):
         """Log exception from async tasks."""
@@ -110,108 +214,137 @@ class Billfred(slixmpp.ClientXMPP):
         """Wrapper for running async task with exception logging."""
         return asyncio.create_task(self.log_exception(func))
 
-    def init_feeds(self):
-        """Initialize feed checker and start initial run."""
-        logger.info('Initializing feeds')
-        self.feed_pool = ThreadPoolExecutor(max_workers=5)
-        self.feed_tasks = []
-        for section in self.config.sections():
-            if section.startswith('rss_'):
-                task = {
-                    'prefix': self.config[section]['prefix'],
-                    'url': self.config[section]['url'],
-                    'time': int(self.config[section]['time']),
-                    'show_body': self.config[section].getboolean(
-                        'show_body', True
-                    )
-                }
-                logger.info('Adding feed %s', task['url'])
-                self.feed_tasks.append(
-                    self.create_task(feed_checker(self, task))
-                )
-        logger.info('Finished feeds initialization')
-
     def send_bot_message(self, data):
-        """Send message from bot."""
-        try:
-            self.send_message(mto=data.get('to', self.room),
-                              mbody=data['message'],
-                              mtype='groupchat')
-        except IqError as e:
-            logger.info("Error sending message to %s: %s",
-                        data['to'],
-                        e.iq['error']['condition'])
-        except IqTimeout:
-            logger.info("No response from %s", data['to'])
-        except Exception:
-            logger.exception("Error on message send")
+        """Queue message from bot for sending."""
+        self.outbox.send(data.get('to', self.room), data['message'],
+                         data.get('priority', PRIORITY_REPLY))
+
+    async def reply(self, to, message):
+        """Send reply to command."""
+        self.send_bot_message({
+            'to': to,
+            'message': message
+        })
 
     def muc_message(self, msg):
-        """Process message and do actions depending on its content."""
+        """Process message and do actions depending on its content.
+
+        Work is queued to scheduler, which bounds number of waiting and
+        running jobs and rate limits every nick.
+        """
         message = msg['body']   # Message body
+        nick = msg['mucnick']
+        room = msg['from'].bare
 
-        # Write message to database
-        self.create_task(self.db.write(msg))
+        # Write message to database. Row is made now, as write can wait
+        # in queue and small tuple is cheaper to keep than the stanza
+        self.scheduler.submit('log', self.db.write_row, self.db.log_row(msg))
 
         # Disable self-interaction
-        if msg['mucnick'] == self.nick:
+        if nick == self.nick:
             return
 
         # Link title parser
         if (
-                not self.links.disabled and
+                self.links_enabled and
                 'http' in message and
-                not self.links.is_ignored(msg['mucnick'])
+                not self.links.is_ignored(nick)
         ):
-            links = Links.extract_links(message)
-            self.create_task(
-                self.links.process(
-                    [{
-                        'to': msg['from'].bare,
-                        'link': link
-                    } for link in links[:self.links.links_limit]]
-                )
+            links = self.links.extract_links(message)
+            self.scheduler.submit(
+                'links', self.links.process,
+                [{
+                    'to': room,
+                    'link': link
+                } for link in links[:self.links.links_limit]],
+                nick=nick
             )
 
         # Bot command parser
         if msg['body'].startswith(self.nick):
 
             tokens = msg['body'].split()
-            if len(tokens) > 1:
-                command = tokens[1]
+            command = tokens[1] if len(tokens) > 1 else ''
 
             # Ping command
             if command == 'ping':
-                self.create_task(self.try_ping(msg['from'], msg['mucnick']))
+                self.scheduler.submit('command', self.try_ping,
+                                      msg['from'], nick, nick=nick)
             elif command == 'version':
-                self.send_bot_message({
-                    'to': msg['from'].bare,
-                    'message': "Bot version: {}".format(BOT_VERSION)
-                })
+                self.scheduler.submit(
+                    'command', self.reply, room,
+                    "Bot version: {}".format(BOT_VERSION), nick=nick
+                )
             elif command == 'help':
-                self.send_bot_message({
-                    'to': msg['from'].bare,
-                    'message': HELP_TEXT
-                })
+                self.scheduler.submit('command', self.reply, room,
+                                      HELP_TEXT, nick=nick)
+            elif command == 'status':
+                self.scheduler.submit('command', self.reply, room,
+                                      self.scheduler.report(), nick=nick)
             elif command.startswith('wiki'):
                 query, lang, in_title = self.wiki.parse_command(msg['body'])
                 if query is not None:
-                    self.create_task(self.wiki.search(query, lang, in_title))
+                    self.scheduler.submit('command', self.wiki.search,
+                                          query, lang, in_title, nick=nick)
+            elif command == 'log' or command.startswith('log:'):
+                query, before_id = self.parse_log_command(msg['body'])
+                if query:
+                    self.scheduler.submit('command', self.search_log,
+                                          room, query, before_id, nick=nick)
             else:
-                self.create_task(ask_eliza(
-                    self,
-                    msg['from'].bare,
-                    ' '.join(tokens[1:])
-                ))
+                self.scheduler.submit('command', self.eliza.ask, room,
+                                      ' '.join(tokens[1:]), nick=nick)
+
+    def parse_log_command(self, message):
+        """Parse log command arguments."""
+        tokens = message.split()
+        if len(tokens) < 3:
+            return None, None
+        cmd = tokens[1].split(':')
+        before_id = None
+        if len(cmd) > 1 and cmd[1].isdigit():
+            before_id = int(cmd[1])
+        return ' '.join(tokens[2:]), before_id
+
+    async def search_log(self, to, query, before_id=None):
+        """Search chat log and send found messages."""
+        logger.info('Searching log for %s before %s', query, before_id)
+        rows = await self.db.search(query, before_id, LOG_RESULTS_LIMIT + 1)
+        if not rows:
+            self.send_bot_message({
+                'to': to,
+                'message': 'Nothing found, sorry'
+            })
+            return
+        result = []
+        for id_, time_, nick, message in rows[:LOG_RESULTS_LIMIT]:
+            message = message or ''
+            if len(message) > LOG_MESSAGE_LENGTH:
+                message = message[:LOG_MESSAGE_LENGTH] + '...'
+            result.append('#{} [{}] {}: {}'.format(
+                id_,
+                time.strftime('%Y-%m-%d %H:%M', time.localtime(time_)),
+                nick,
+                message
+            ))
+        if len(rows) > LOG_RESULTS_LIMIT:
+            result.append('More: {} log:{} {}'.format(
+                self.nick, rows[LOG_RESULTS_LIMIT - 1][0], query
+            ))
+        self.send_bot_message({
+            'to': to,
+            'message': '\n'.join(result)
+        })
 
     async def try_ping(self, pingjid, nick):
         """Ping user."""
         logger.debug('Got ping from nick "%s" jid "%s"', nick, pingjid)
         try:
             rtt = await self['xep_0199'].ping(pingjid, timeout=10)
-            self.send_message(mto=pingjid.bare,
-                              mbody="%s, pong is: %s" % (nick, rtt),
-                              mtype='groupchat')
+            self.send_bot_message({
+                'to': pingjid.bare,
+                'message': "%s, pong is: %s" % (nick, rtt)
+            })
             logger.debug('Successfully pinged %s (%s)', nick, pingjid)
         except IqError as e:
             logger.info("Error pinging %s: %s",
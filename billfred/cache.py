@@ -0,0 +1,103 @@
+import json
+import time
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class Cache:
+    """LRU cache with expiration, persisted in database.
+
+    Entries are kept in memory and written through to cache table, so
+    cache survives restarts. Values must be JSON serializable. Expired
+    entries are kept for stale seconds more and can be served by lookup
+    while caller refreshes them.
+    """
+
+    def __init__(self, db, namespace, size, stale=0):
+        self.db = db
+        self.namespace = namespace
+        self.size = size
+        self.stale = stale
+        self.entries = OrderedDict()
+        self.loaded = False
+        self.stats = {
+            'hits': 0,
+            'stale': 0,
+            'misses': 0,
+            'expired': 0,
+            'evictions': 0,
+        }
+
+    @property
+    def hit_rate(self):
+        """Share of lookups answered from cache, stale ones included."""
+        hits = self.stats['hits'] + self.stats['stale']
+        total = hits + self.stats['misses']
+        return hits / total if total else 0.0
+
+    async def load(self):
+        """Load saved entries from database."""
+        self.loaded = True
+        try:
+            rows = await self.db.cache_load(self.namespace, self.size,
+                                            self.stale)
+        except Exception:
+            logger.exception('Can not load %s cache', self.namespace)
+            return
+        # Entries that expire soon are evicted first
+        for key, value, expires in reversed(rows):
+            if key not in self.entries:
+                self.entries[key] = (json.loads(value), expires)
+                self.entries.move_to_end(key, last=False)
+        logger.info('Loaded %s entries to %s cache',
+                    len(rows), self.namespace)
+
+    async def get(self, key):
+        """Get cached value or None."""
+        value, fresh = await self.lookup(key)
+        return value if fresh else None
+
+    async def lookup(self, key):
+        """Get cached value and flag if it's still fresh.
+
+        Returns (None, False) if there is no value, stale value is
+        returned with False flag.
+        """
+        if not self.loaded:
+            await self.load()
+        item = self.entries.get(key)
+        if item is None:
+            self.stats['misses'] += 1
+            return None, False
+        value, expires = item
+        now = time.time()
+        if expires + self.stale < now:
+            del self.entries[key]
+            self.stats['expired'] += 1
+            self.stats['misses'] += 1
+            return None, False
+        self.entries.move_to_end(key)
+        if expires < now:
+            self.stats['stale'] += 1
+            return value, False
+        self.stats['hits'] += 1
+        return value, True
+
+    async def set(self, key, value, ttl):
+        """Put value to cache for ttl seconds."""
+        if not self.loaded:
+            await self.load()
+        expires = time.time() + ttl
+        self.entries[key] = (value, expires)
+        self.entries.move_to_end(key)
+        evicted = []
+        while len(self.entries) > self.size:
+            evicted.append(self.entries.popitem(last=False)[0])
+        self.stats['evictions'] += len(evicted)
+        try:
+            await self.db.cache_set(self.namespace, key, json.dumps(value),
+                                    expires, evicted)
+        except Exception:
+            logger.exception('Can not save %s cache entry', self.namespace)
@@ -1,24 +1,158 @@
+import os
+import re
 import time
+import glob
+import shutil
+import asyncio
 import logging
 import aiosqlite
+from contextlib import asynccontextmanager
+from urllib.request import pathname2url
 
 logger = logging.getLogger(__name__)
 
+# Partition period name -> (key format, key regex)
+PARTITION_PERIODS = {
+    'day': ('%Y-%m-%d', r'\d{4}-\d{2}-\d{2}'),
+    'week': ('%G-W%V', r'\d{4}-W\d{2}'),
+    'month': ('%Y-%m', r'\d{4}-\d{2}'),
+    'year': ('%Y', r'\d{4}'),
+}
+
+
+def database_options(config):
+    """Get database path and options from bot config."""
+    path = '{}_chatlog.db'.format(config['account']['room'])
+    options = None
+    if 'database' in config:
+        options = config['database']
+        if options.get('database_path'):
+            path = options['database_path']
+    return path, options
+
+
+def partition_key(timestamp, period):
+    """Get partition key for timestamp, keys sort in time order."""
+    return time.strftime(PARTITION_PERIODS[period][0], time.gmtime(timestamp))
+
+
+def partition_path(path, key):
+    """Get partition file path for key."""
+    base, ext = os.path.splitext(path)
+    return '{}_{}{}'.format(base, key, ext or '.db')
+
+
+def list_partitions(path, period):
+    """Get list of (key, path) of existing partitions sorted by time."""
+    base, ext = os.path.splitext(path)
+    ext = ext or '.db'
+    key_re = re.compile(r'{}_({}){}$'.format(
+        re.escape(base), PARTITION_PERIODS[period][1], re.escape(ext)
+    ))
+    result = []
+    for name in glob.glob('{}_*{}'.format(glob.escape(base), ext)):
+        match = key_re.match(name)
+        if match:
+            result.append((match.group(1), name))
+    return sorted(result)
+
 
 class Database:
     """Async database wrapper."""
-    VERSION = '0.2'
+    VERSION = '0.4'
+    MAX_ID = 2 ** 63 - 1
+    BACKFILL_CHUNK = 5000
+    BACKFILL_PAUSE = 0.1
+    BATCH_SIZE = 100
+    FLUSH_INTERVAL = 500  # milliseconds
+    QUEUE_SIZE = 10000
+    SYNCHRONOUS = 'NORMAL'
+    SYNCHRONOUS_LEVELS = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+    READ_PAGE_SIZE = 500
+    READ_CONNECTIONS = 2
 
-    def __init__(self, path):
+    def __init__(self, path, options=None):
         self.path = path
         self.db = None
+        self.queue = None
+        self.writer_task = None
+        self.backfill_task = None
+        self.stopping = False
+        self.write_lock = None
+        self.readers = None
+        self.read_connections = self.READ_CONNECTIONS
+        self.batch_size = self.BATCH_SIZE
+        self.flush_interval = self.FLUSH_INTERVAL / 1000
+        self.queue_size = self.QUEUE_SIZE
+        self.synchronous = self.SYNCHRONOUS
+        self.partition = None
+        self.retention = 0
+        self.archive_path = None
+        self.log_schema = 'main'
+        self.current_partition = None
+        if options:
+            if options.get('batch_size'):
+                self.batch_size = max(1, int(options['batch_size']))
+            if options.get('flush_interval'):
+                self.flush_interval = int(options['flush_interval']) / 1000
+            if options.get('queue_size'):
+                self.queue_size = max(1, int(options['queue_size']))
+            if options.get('synchronous'):
+                self.synchronous = options['synchronous'].upper()
+            if options.get('read_connections'):
+                self.read_connections = max(
+                    1, int(options['read_connections'])
+                )
+            if options.get('partition', 'none') != 'none':
+                self.partition = options['partition']
+            if options.get('retention'):
+                self.retention = int(options['retention'])
+            if options.get('archive_path'):
+                self.archive_path = options['archive_path']
+        if self.partition and self.partition not in PARTITION_PERIODS:
+            logger.warning('Unknown partition period %s, partitioning '
+                           'disabled', self.partition)
+            self.partition = None
+        if self.synchronous not in self.SYNCHRONOUS_LEVELS:
+            logger.warning('Unknown synchronous level %s, using %s',
+                           self.synchronous, self.SYNCHRONOUS)
+            self.synchronous = self.SYNCHRONOUS
+        self.stats = {
+            'queued': 0,
+            'written': 0,
+            'flushes': 0,
+            'errors': 0,
+            'max_depth': 0,
+            'last_flush_ms': 0.0,
+            'max_flush_ms': 0.0,
+        }
 
     async def init(self):
         """Create db connection and initialize db structure."""
         logger.info('Connecting to db %s', self.path)
         self.db = await aiosqlite.connect(self.path)
+        await self.db.execute(r'PRAGMA journal_mode=WAL')
+        await self.db.execute(
+            r'PRAGMA synchronous={}'.format(self.synchronous)
+        )
         await self.create_db()
         await self.migrate_db()
+        if self.partition:
+            await self.rotate_partition(time.time())
+        readers = asyncio.Queue()
+        for _ in range(self.read_connections):
+            readers.put_nowait(await self.connect_reader(self.path))
+        self.readers = readers
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        self.write_lock = asyncio.Lock()
+        self.stopping = False
+        self.writer_task = asyncio.create_task(self.writer())
+        self.backfill_task = asyncio.create_task(self.run_backfill())
+
+    @property
+    def queue_depth(self):
+        """Number of messages waiting to be written."""
+        return self.queue.qsize() if self.queue else 0
 
     async def create_db(self):
         """Create database if not exists."""
@@ -37,19 +171,69 @@ class Database:
           time INTEGER NOT NULL,
           version TEXT NOT NULL
         )''')
+        await self.db.execute(r'''
+        CREATE TABLE IF NOT EXISTS fts_backfill (
+          id INTEGER PRIMARY KEY,
+          last_id INTEGER NOT NULL,
+          max_id INTEGER NOT NULL
+        )''')
+        await self.db.execute(r'''
+        CREATE TABLE IF NOT EXISTS feed_state (
+          feed TEXT PRIMARY KEY,
+          last_date INTEGER,
+          etag TEXT,
+          modified TEXT,
+          ordered INTEGER NOT NULL DEFAULT 0,
+          updated INTEGER NOT NULL
+        )''')
+        await self.db.execute(r'''
+        CREATE TABLE IF NOT EXISTS feed_seen (
+          feed TEXT NOT NULL,
+          guid TEXT NOT NULL,
+          PRIMARY KEY (feed, guid)
+        )''')
+        await self.db.execute(r'''
+        CREATE TABLE IF NOT EXISTS cache (
+          namespace TEXT NOT NULL,
+          key TEXT NOT NULL,
+          value TEXT NOT NULL,
+          expires REAL NOT NULL,
+          PRIMARY KEY (namespace, key)
+        )''')
         await self.db.commit()
 
     async def migrate_db(self):
         """Migrate database from old structure to new one if required.."""
+        version = None
         async with self.db.execute(
                 r'SELECT version FROM version ORDER BY time DESC LIMIT 1'
         ) as cursor:
             row = await cursor.fetchone()
-            if row and row[0] == self.VERSION:
+            if row:
+                version = row[0]
+            if version == self.VERSION:
                 # Already migrated
                 logger.info('Database is up to date')
                 return
 
+        if version is None:
+            await self.migrate_0_2()
+        if version in (None, '0.2'):
+            await self.migrate_0_3()
+        if version in (None, '0.2', '0.3'):
+            await self.migrate_0_4()
+
+        # Migrated successfully
+        await self.db.execute(
+            r'INSERT OR REPLACE INTO version (id, time, version) '
+            'VALUES (?, ?, ?)',
+            (1, time.time(), self.VERSION)
+        )
+        await self.db.commit()
+        logger.info('Updated to version %s', self.VERSION)
+
+    async def migrate_0_2(self):
+        """Rename pre-0.2 columns."""
         # Check if database is new
         async with self.db.execute(
                 r"SELECT COUNT(*) AS CNTREC FROM pragma_table_info('chat_log') WHERE name=?",
@@ -61,7 +245,7 @@ class Database:
                 logger.info('Database is in new state')
             else:
                 # Only pre-0.2 supported now
-                logger.info('Migrating database to %s', self.VERSION)
+                logger.info('Migrating database to 0.2')
                 await self.db.execute(
                     r'ALTER TABLE chat_log RENAME COLUMN jit TO jid'
                 )
@@ -69,30 +253,592 @@ class Database:
                     r'ALTER TABLE chat_log RENAME COLUMN name TO nick'
                 )
 
-        # Migrated successfully
+    async def migrate_0_3(self):
+        """Add indexes and full-text search table.
+
+        Existing rows are added to the search index later in chunks by
+        backfill_fts, new rows are indexed by triggers right away.
+        """
+        logger.info('Migrating database to 0.3')
+        await self.create_log_schema('main')
         await self.db.execute(
-            r'INSERT INTO version (id, time, version) VALUES (?, ?, ?)',
-            (1, time.time(), self.VERSION)
+            r'INSERT OR REPLACE INTO fts_backfill (id, last_id, max_id) '
+            'SELECT 1, 0, IFNULL(MAX(id), 0) FROM chat_log'
         )
-        await self.db.commit()
-        logger.info('Updated to version %s', self.VERSION)
 
-    async def write(self, message):
-        """Write message to database."""
+    async def migrate_0_4(self):
+        """Add ordered flag to feed state."""
+        async with self.db.execute(
+                r"SELECT COUNT(*) FROM pragma_table_info('feed_state') "
+                'WHERE name = ?', ('ordered',)
+        ) as cursor:
+            row = await cursor.fetchone()
+        if row[0]:
+            return
+        logger.info('Migrating database to 0.4')
+        await self.db.execute(
+            r'ALTER TABLE feed_state '
+            'ADD COLUMN ordered INTEGER NOT NULL DEFAULT 0'
+        )
+
+    async def create_log_schema(self, schema):
+        """Create chat log tables, indexes and triggers in schema."""
+        await self.db.execute(r'''
+        CREATE TABLE IF NOT EXISTS {schema}.chat_log (
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          time INTEGER NOT NULL,
+          jid TEXT NOT NULL,
+          nick TEXT NOT NULL,
+          message TEXT
+        )'''.format(schema=schema))
+        await self.db.execute(r'''
+        CREATE TABLE IF NOT EXISTS {schema}.fts_backfill (
+          id INTEGER PRIMARY KEY,
+          last_id INTEGER NOT NULL,
+          max_id INTEGER NOT NULL
+        )'''.format(schema=schema))
+        await self.db.execute(
+            r'CREATE INDEX IF NOT EXISTS {schema}.chat_log_time '
+            'ON chat_log (time)'.format(schema=schema)
+        )
+        await self.db.execute(
+            r'CREATE INDEX IF NOT EXISTS {schema}.chat_log_nick_time '
+            'ON chat_log (nick, time)'.format(schema=schema)
+        )
+        await self.db.execute(r'''
+        CREATE VIRTUAL TABLE IF NOT EXISTS {schema}.chat_log_fts USING fts5 (
+          message,
+          content='chat_log',
+          content_rowid='id'
+        )'''.format(schema=schema))
+        # Rows that aren't backfilled yet must not be removed from index
+        await self.db.execute(r'''
+        CREATE TRIGGER IF NOT EXISTS {schema}.chat_log_fts_insert
+        AFTER INSERT ON chat_log BEGIN
+          INSERT INTO chat_log_fts (rowid, message)
+          VALUES (new.id, new.message);
+        END'''.format(schema=schema))
+        await self.db.execute(r'''
+        CREATE TRIGGER IF NOT EXISTS {schema}.chat_log_fts_delete
+        AFTER DELETE ON chat_log
+        WHEN NOT EXISTS (SELECT 1 FROM fts_backfill
+                         WHERE old.id > last_id AND old.id <= max_id)
+        BEGIN
+          INSERT INTO chat_log_fts (chat_log_fts, rowid, message)
+          VALUES ('delete', old.id, old.message);
+        END'''.format(schema=schema))
+        await self.db.execute(r'''
+        CREATE TRIGGER IF NOT EXISTS {schema}.chat_log_fts_update
+        AFTER UPDATE ON chat_log
+        WHEN NOT EXISTS (SELECT 1 FROM fts_backfill
+                         WHERE old.id > last_id AND old.id <= max_id)
+        BEGIN
+          INSERT INTO chat_log_fts (chat_log_fts, rowid, message)
+          VALUES ('delete', old.id, old.message);
+          INSERT INTO chat_log_fts (rowid, message)
+          VALUES (new.id, new.message);
+        END'''.format(schema=schema))
+
+    async def backfill_fts(self):
+        """Add rows written before 0.3 to full-text index.
+
+        Works in small transactions and saves progress after each one,
+        so it can be interrupted and resumed on next start.
+        """
+        async with self.db.execute(
+                r'SELECT last_id, max_id FROM fts_backfill WHERE id = 1'
+        ) as cursor:
+            row = await cursor.fetchone()
+        if not row:
+            return
+        last_id, max_id = row
+        logger.info('Backfilling full-text index from id %s to %s',
+                    last_id, max_id)
+        while last_id < max_id:
+            if self.stopping:
+                logger.info('Full-text index backfill interrupted at id %s',
+                            last_id)
+                return
+            async with self.write_lock:
+                async with self.db.execute(
+                        r'SELECT MAX(id) FROM (SELECT id FROM chat_log '
+                        'WHERE id > ? AND id <= ? ORDER BY id LIMIT ?)',
+                        (last_id, max_id, self.BACKFILL_CHUNK)
+                ) as cursor:
+                    row = await cursor.fetchone()
+                chunk_end = row[0] if row[0] is not None else max_id
+                await self.db.execute(
+                    r'INSERT INTO chat_log_fts (rowid, message) '
+                    'SELECT id, message FROM chat_log '
+                    'WHERE id > ? AND id <= ?',
+                    (last_id, chunk_end)
+                )
+                await self.db.execute(
+                    r'UPDATE fts_backfill SET last_id = ? WHERE id = 1',
+                    (chunk_end,)
+                )
+                await self.db.commit()
+            last_id = chunk_end
+            logger.debug('Full-text index backfilled up to id %s', last_id)
+            # Let writer and other tasks run between chunks
+            await asyncio.sleep(self.BACKFILL_PAUSE)
+        async with self.write_lock:
+            await self.db.execute(r'DELETE FROM fts_backfill WHERE id = 1')
+            await self.db.commit()
+        logger.info('Full-text index backfill finished')
+
+    async def run_backfill(self):
+        """Run backfill with exception logging."""
+        try:
+            await self.backfill_fts()
+        except Exception:
+            logger.exception('Full-text index backfill failed')
+
+    def reader_uri(self, path):
+        """Get read-only URI for database file."""
+        return 'file:{}?mode=ro'.format(pathname2url(os.path.abspath(path)))
+
+    async def connect_reader(self, path):
+        """Open read-only connection to database file."""
+        conn = await aiosqlite.connect(self.reader_uri(path), uri=True)
+        await conn.execute(r'PRAGMA query_only=ON')
+        return conn
+
+    @asynccontextmanager
+    async def reader(self):
+        """Borrow read-only connection to main database.
+
+        Reads don't go through writer connection, so slow queries don't
+        delay chat log writes. Without initialized pool temporary
+        connection is opened.
+        """
+        readers = self.readers
+        if readers is None:
+            conn = await self.connect_reader(self.path)
+            try:
+                yield conn
+            finally:
+                await conn.close()
+            return
+        conn = await readers.get()
+        try:
+            yield conn
+        finally:
+            if readers is self.readers:
+                readers.put_nowait(conn)
+            else:
+                # Pool was closed while connection was borrowed
+                await conn.close()
+
+    @asynccontextmanager
+    async def log_reader(self, path):
+        """Borrow read connection for chat log file.
+
+        Yields connection and schema name that contains chat log.
+        """
+        async with self.reader() as conn:
+            if path == self.path:
+                yield conn, 'main'
+                return
+            await conn.execute(r'ATTACH DATABASE ? AS src',
+                               (self.reader_uri(path),))
+            try:
+                yield conn, 'src'
+            finally:
+                await conn.execute(r'DETACH DATABASE src')
+
+    def log_sources(self, since=None, until=None):
+        """Get database files with chat log rows for time range.
+
+        Files are sorted in time order, main database goes first because
+        it contains messages written before partitioning was enabled.
+        """
+        sources = [self.path]
+        if self.partition:
+            since_key = until_key = None
+            if since is not None:
+                since_key = partition_key(since, self.partition)
+            if until is not None:
+                until_key = partition_key(until, self.partition)
+            for key, path in list_partitions(self.path, self.partition):
+                if since_key is not None and key < since_key:
+                    continue
+                if until_key is not None and key > until_key:
+                    continue
+                sources.append(path)
+        return sources
+
+    async def iter_log(self, since=None, until=None, nick=None):
+        """Iterate over chat log in time order.
+
+        Yields (id, time, jid, nick, message) tuples. Partitions are read
+        one after another in pages of READ_PAGE_SIZE rows, every page is a
+        separate short read.
+        """
+        where = []
+        args = []
+        if since is not None:
+            where.append('time >= ?')
+            args.append(since)
+        if until is not None:
+            where.append('time < ?')
+            args.append(until)
+        if nick is not None:
+            where.append('nick = ?')
+            args.append(nick)
+        # Ids of matching rows are found once with indexes, pages then
+        # seek by primary key. Unary plus keeps SQLite from using an
+        # index on filter columns for pages, it would sort every page.
+        bounds_sql = r'SELECT MIN(id), MAX(id) FROM {}.chat_log'
+        if where:
+            bounds_sql += ' WHERE ' + ' AND '.join(where)
+        sql = (r'SELECT id, time, jid, nick, message FROM {{}}.chat_log '
+               'WHERE id > ? AND id <= ?{} ORDER BY id LIMIT ?'.format(
+                   ''.join(' AND +' + w for w in where)))
+        for path in self.log_sources(since, until):
+            async with self.log_reader(path) as (conn, schema):
+                async with conn.execute(bounds_sql.format(schema),
+                                        args) as cursor:
+                    first_id, max_id = await cursor.fetchone()
+            if first_id is None:
+                continue
+            last_id = first_id - 1
+            while True:
+                # Connection is borrowed for one page only
+                async with self.log_reader(path) as (conn, schema):
+                    async with conn.execute(
+                            sql.format(schema),
+                            (last_id, max_id, *args, self.READ_PAGE_SIZE)
+                    ) as cursor:
+                        rows = await cursor.fetchall()
+                for row in rows:
+                    yield row
+                if len(rows) < self.READ_PAGE_SIZE:
+                    break
+                last_id = rows[-1][0]
+
+    async def search(self, query, before_id=None, limit=5):
+        """Find messages matching query, newest first.
+
+        Returns list of (id, time, nick, message) tuples. Pass id of the
+        last returned row as before_id to get next page.
+        """
+        terms = ' '.join('"{}"'.format(t.replace('"', '""'))
+                         for t in query.split())
+        if not terms:
+            return []
+        if before_id is None:
+            before_id = self.MAX_ID
+        result = []
+        # Ids grow across partitions, so newest partitions go first
+        for path in reversed(self.log_sources()):
+            async with self.log_reader(path) as (conn, schema):
+                async with conn.execute(
+                        r'SELECT c.id, c.time, c.nick, c.message '
+                        'FROM {0}.chat_log_fts(?) f '
+                        'JOIN {0}.chat_log c ON c.id = f.rowid '
+                        'WHERE f.rowid < ? '
+                        'ORDER BY f.rowid DESC LIMIT ?'.format(schema),
+                        (terms, before_id, limit - len(result))
+                ) as cursor:
+                    result.extend(await cursor.fetchall())
+            if len(result) >= limit:
+                break
+        return result
+
+    async def last_log_id(self):
+        """Get last chat log id over main database and partitions."""
+        sql = r"SELECT seq FROM {}.sqlite_sequence WHERE name = 'chat_log'"
+        result = 0
+        schemas = ['main']
+        partitions = list_partitions(self.path, self.partition)
+        if self.current_partition:
+            schemas.append('part')
+        elif partitions:
+            await self.db.execute(r'ATTACH DATABASE ? AS prev',
+                                  (partitions[-1][1],))
+            schemas.append('prev')
         try:
-            args = (time.time(), str(message.get('from')),
-                    message.get('mucnick'), message.get('body'))
-            logger.debug('Writing message %s', args)
+            for schema in schemas:
+                async with self.db.execute(sql.format(schema)) as cursor:
+                    row = await cursor.fetchone()
+                    if row and row[0] > result:
+                        result = row[0]
+        finally:
+            if 'prev' in schemas:
+                await self.db.execute(r'DETACH DATABASE prev')
+        return result
+
+    async def rotate_partition(self, timestamp):
+        """Attach partition for timestamp as current chat log target.
+
+        Must not be called inside transaction. New partition continues
+        id sequence of previous one, so ids stay unique over all files.
+        """
+        key = partition_key(timestamp, self.partition)
+        if self.current_partition and key <= self.current_partition:
+            return
+        path = partition_path(self.path, key)
+        is_new = not os.path.exists(path)
+        last_id = 0
+        if is_new:
+            last_id = await self.last_log_id()
+        if self.current_partition:
+            await self.db.execute(r'DETACH DATABASE part')
+        await self.db.execute(r'ATTACH DATABASE ? AS part', (path,))
+        await self.db.execute(r'PRAGMA part.journal_mode=WAL')
+        await self.db.execute(
+            r'PRAGMA part.synchronous={}'.format(self.synchronous)
+        )
+        await self.create_log_schema('part')
+        if is_new:
             await self.db.execute(
-                (r'INSERT INTO chat_log (time, jid, nick, message) '
-                 'VALUES (?, ?, ?, ?)'), args
+                r'INSERT INTO part.sqlite_sequence (name, seq) '
+                "VALUES ('chat_log', ?)", (last_id,)
             )
+        await self.db.commit()
+        self.current_partition = key
+        self.log_schema = 'part'
+        logger.info('Writing chat log to partition %s', path)
+        self.apply_retention()
+
+    def apply_retention(self):
+        """Drop or archive partitions older than retention limit."""
+        if not self.retention:
+            return
+        partitions = list_partitions(self.path, self.partition)
+        for key, path in partitions[:-self.retention]:
+            if key >= self.current_partition:
+                continue
+            for name in (path, path + '-wal', path + '-shm'):
+                if not os.path.exists(name):
+                    continue
+                if self.archive_path:
+                    os.makedirs(self.archive_path, exist_ok=True)
+                    shutil.move(name, os.path.join(self.archive_path,
+                                                   os.path.basename(name)))
+                else:
+                    os.remove(name)
+            if self.archive_path:
+                logger.info('Archived partition %s to %s',
+                            path, self.archive_path)
+            else:
+                logger.info('Removed partition %s', path)
+
+    async def get_feed_state(self, feed):
+        """Get saved feed state or None if feed wasn't checked before."""
+        async with self.reader() as conn:
+            async with conn.execute(
+                    r'SELECT last_date, etag, modified, ordered '
+                    'FROM feed_state '
+                    'WHERE feed = ?', (feed,)
+            ) as cursor:
+                row = await cursor.fetchone()
+            if not row:
+                return None
+            async with conn.execute(
+                    r'SELECT guid FROM feed_seen WHERE feed = ?', (feed,)
+            ) as cursor:
+                seen = {r[0] for r in await cursor.fetchall()}
+        return {
+            'last_date': row[0],
+            'etag': row[1],
+            'modified': row[2],
+            'ordered': bool(row[3]),
+            'seen': seen,
+        }
+
+    async def save_feed_state(self, feed, state, new_ids, seen_limit):
+        """Save feed state and remember new entry ids.
+
+        new_ids go from oldest to newest, only seen_limit latest ids are
+        kept for every feed.
+        """
+        async with self.write_lock:
+            await self.db.execute(
+                r'INSERT OR REPLACE INTO feed_state '
+                '(feed, last_date, etag, modified, ordered, updated) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (feed, state['last_date'], state['etag'],
+                 state['modified'], int(state['ordered']), time.time())
+            )
+            if new_ids:
+                await self.db.executemany(
+                    r'INSERT OR IGNORE INTO feed_seen (feed, guid) '
+                    'VALUES (?, ?)', [(feed, i) for i in new_ids]
+                )
+                await self.db.execute(
+                    r'DELETE FROM feed_seen WHERE feed = ? AND rowid NOT IN '
+                    '(SELECT rowid FROM feed_seen WHERE feed = ? '
+                    'ORDER BY rowid DESC LIMIT ?)',
+                    (feed, feed, seen_limit)
+                )
             await self.db.commit()
-        except Exception:
-            logger.exception('Can not write message to database')
+
+    async def cache_load(self, namespace, limit, stale=0):
+        """Drop old cache entries and return up to limit other ones.
+
+        Entries that expired more than stale seconds ago are dropped.
+        Returns list of (key, value, expires), entries that expire later
+        go first.
+        """
+        async with self.write_lock:
+            await self.db.execute(
+                r'DELETE FROM cache WHERE namespace = ? AND (expires < ? OR '
+                'rowid NOT IN (SELECT rowid FROM cache WHERE namespace = ? '
+                'ORDER BY expires DESC LIMIT ?))',
+                (namespace, time.time() - stale, namespace, limit)
+            )
+            await self.db.commit()
+        async with self.reader() as conn:
+            async with conn.execute(
+                    r'SELECT key, value, expires FROM cache '
+                    'WHERE namespace = ? ORDER BY expires DESC',
+                    (namespace,)
+            ) as cursor:
+                return await cursor.fetchall()
+
+    async def cache_set(self, namespace, key, value, expires, evicted=()):
+        """Save cache entry and remove evicted ones."""
+        async with self.write_lock:
+            await self.db.execute(
+                r'INSERT OR REPLACE INTO cache '
+                '(namespace, key, value, expires) VALUES (?, ?, ?, ?)',
+                (namespace, key, value, expires)
+            )
+            if evicted:
+                await self.db.executemany(
+                    r'DELETE FROM cache WHERE namespace = ? AND key = ?',
+                    [(namespace, k) for k in evicted]
+                )
+            await self.db.commit()
+
+    @staticmethod
+    def log_row(message, timestamp=None):
+        """Get (time, jid, nick, message) chat log row for message.
+
+        timestamp is message time, current time is used if it's None.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        return (timestamp, str(message.get('from')),
+                message.get('mucnick'), message.get('body'))
+
+    async def write(self, message, timestamp=None):
+        """Queue message for writing to database."""
+        await self.write_row(self.log_row(message, timestamp))
+
+    async def write_row(self, args):
+        """Queue chat log row from log_row for writing to database."""
+        if self.queue is None:
+            logger.error('Database is not initialized, message lost')
+            return
+        logger.debug('Queueing message %s', args)
+        await self.queue.put(args)
+        self.stats['queued'] += 1
+        depth = self.queue.qsize()
+        if depth > self.stats['max_depth']:
+            self.stats['max_depth'] = depth
+
+    async def writer(self):
+        """Collect queued messages and write them in batches.
+
+        Batch is flushed when it reaches batch_size messages or when
+        flush_interval has passed since its first message, whichever
+        comes first. None in queue means shutdown.
+        """
+        loop = asyncio.get_running_loop()
+        running = True
+        while running:
+            item = await self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                if self.queue.empty():
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self.queue.get(),
+                                                      timeout)
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    item = self.queue.get_nowait()
+                if item is None:
+                    running = False
+                    break
+                batch.append(item)
+            await self.flush(batch)
+
+    def split_batch(self, batch):
+        """Split batch into parts that belong to the same partition."""
+        if not self.partition:
+            return [batch]
+        parts = []
+        last_key = None
+        for item in batch:
+            key = partition_key(item[0], self.partition)
+            if key != last_key:
+                parts.append([])
+                last_key = key
+            parts[-1].append(item)
+        return parts
+
+    async def flush(self, batch):
+        """Write batch of messages in one transaction."""
+        start = time.perf_counter()
+        async with self.write_lock:
+            try:
+                for part in self.split_batch(batch):
+                    if self.partition:
+                        await self.rotate_partition(part[0][0])
+                    await self.db.executemany(
+                        (r'INSERT INTO {}.chat_log (time, jid, nick, message) '
+                         'VALUES (?, ?, ?, ?)').format(self.log_schema), part
+                    )
+                    await self.db.commit()
+                    self.stats['written'] += len(part)
+            except Exception:
+                self.stats['errors'] += 1
+                logger.exception('Can not write %s messages to database',
+                                 len(batch))
+                await self.db.rollback()
+        elapsed = (time.perf_counter() - start) * 1000
+        self.stats['flushes'] += 1
+        self.stats['last_flush_ms'] = elapsed
+        if elapsed > self.stats['max_flush_ms']:
+            self.stats['max_flush_ms'] = elapsed
+        logger.debug('Flushed %s messages in %.1f ms, queue depth %s',
+                     len(batch), elapsed, self.queue_depth)
 
     async def close(self):
-        """Destroy db connection."""
+        """Flush pending messages and destroy db connection."""
+        if self.backfill_task:
+            # Let current chunk finish, backfill resumes on next start
+            self.stopping = True
+            await self.backfill_task
+            self.backfill_task = None
+        if self.writer_task:
+            logger.info('Flushing %s queued messages', self.queue_depth)
+            if not self.writer_task.done():
+                await self.queue.put(None)
+            try:
+                await self.writer_task
+            except Exception:
+                logger.exception('Writer failed on shutdown')
+            self.writer_task = None
+            logger.info('Database writer stats: %s', self.stats)
+        if self.readers:
+            readers = self.readers
+            self.readers = None
+            while not readers.empty():
+                await readers.get_nowait().close()
         if self.db:
             logger.info('Closing db')
             await self.db.close()
+            self.db = None
+            self.current_partition = None
+            self.log_schema = 'main'
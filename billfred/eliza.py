@@ -12,6 +12,9 @@ import logging
 import asyncio
 import re
 import random
+from concurrent.futures import ThreadPoolExecutor
+
+from billfred.elizascript import Script
 
 logger = logging.getLogger(__name__)
 
@@ -239,32 +242,95 @@ psychobabble = [
 ]
 
 
+# Whole tokens that are replaced by reflect
+REFLECT_RE = re.compile(r'(?<!\S)({})(?!\S)'.format(
+    '|'.join(re.escape(word) for word in
+             sorted(reflections, key=len, reverse=True))
+))
+# Messages longer than this go to thread pool if it's enabled
+INLINE_LENGTH = 1000
+
+
+def compile_rules(rules):
+    """Compile rules into one regex with group dispatch table.
+
+    Every rule pattern is wrapped in its own group. Alternatives are
+    tried in order, so the first rule that matches wins just like with
+    separate patterns. Table maps outer group index to rule responses
+    and indexes of the rule groups.
+    """
+    parts = []
+    table = {}
+    group = 1
+    for pattern, responses in rules:
+        count = re.compile(pattern).groups
+        parts.append('({})'.format(pattern))
+        table[group] = (responses, range(group + 1, group + 1 + count))
+        group += 1 + count
+    return re.compile('|'.join(parts)), table
+
+
+RULES_RE, RULES_TABLE = compile_rules(psychobabble)
+
+
 def reflect(fragment):
-    tokens = fragment.lower().split()
-    for i, token in enumerate(tokens):
-        if token in reflections:
-            tokens[i] = reflections[token]
-    return ' '.join(tokens)
+    """Swap first and second person words."""
+    return REFLECT_RE.sub(lambda m: reflections[m.group(1)],
+                          ' '.join(fragment.lower().split()))
 
 
 def analyze(statement):
     """Analyze message and get possible answer."""
-    for pattern, responses in psychobabble:
-        match_ = re.match(pattern, statement.rstrip(".!"))
-        if match_:
-            response = random.choice(responses)
-            return response.format(*[reflect(g) for g in match_.groups()])
-
-
-async def ask_eliza(client, to, message):
-    """Ask Eliza something."""
-    logger.debug('Asking Eliza for "%s"', message)
-    loop = asyncio.get_running_loop()
-    answer = await loop.run_in_executor(
-        client.eliza_pool, analyze, message
-    )
-    if answer:
-        client.send_bot_message({
-            'to': to,
-            'message': answer
-        })
+    match_ = RULES_RE.match(statement.rstrip(".!"))
+    if match_:
+        responses, groups = RULES_TABLE[match_.lastindex]
+        response = random.choice(responses)
+        return response.format(*[reflect(match_.group(i) or '')
+                                 for i in groups])
+
+
+class Eliza:
+    """Eliza responder for messages that aren't commands.
+
+    Script from [eliza] script is used if it's loaded, built-in rules
+    otherwise. Answer is found right in event loop, only long messages
+    go to thread pool if it's enabled.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.pool = None
+        self.script = None
+        conf = client.config
+        if 'eliza' in conf:
+            c = conf['eliza']
+            if c.getboolean('thread_pool', False):
+                self.pool = ThreadPoolExecutor(max_workers=5)
+            if c.get('script'):
+                try:
+                    self.script = Script.from_file(c['script'])
+                    logger.info('Loaded Eliza script with %s keys',
+                                len(self.script.keys))
+                except (OSError, ValueError):
+                    logger.exception('Can not load Eliza script, '
+                                     'using built-in rules')
+
+    async def ask(self, to, message):
+        """Ask Eliza something."""
+        logger.debug('Asking Eliza for "%s"', message)
+        respond = analyze
+        if self.script is not None:
+            respond = self.script.respond
+        if self.pool is None or len(message) <= INLINE_LENGTH:
+            answer = respond(message)
+        else:
+            loop = asyncio.get_running_loop()
+            answer = await loop.run_in_executor(self.pool, respond, message)
+        if answer:
+            self.client.send_bot_message({
+                'to': to,
+                'message': answer
+            })
+
+    async def close(self):
+        """Nothing to stop, pool is kept between reconnects."""
@@ -0,0 +1,202 @@
+import re
+import random
+import logging
+import collections
+
+logger = logging.getLogger(__name__)
+
+PUNCTUATION_RE = re.compile(r'\s*([.,;!?]+)\s*')
+REFERENCE_RE = re.compile(r'\((\d+)\)')
+MEMORY_SIZE = 20
+
+
+class Decomp:
+    """Decomposition rule with its reassembly rules.
+
+    Pattern is compiled to regex on first use.
+    """
+
+    def __init__(self, parts, save, script):
+        self.parts = parts
+        self.save = save
+        self.script = script
+        self.reasmbs = []
+        self.next_reasmb = 0
+        self.regex = None
+
+    def compile(self):
+        """Build regex, every * and @synonym part is a group."""
+        items = []
+        for part in self.parts:
+            if part == '*':
+                items.append('(.*)')
+                continue
+            if part.startswith('@'):
+                words = self.script.synons.get(part[1:].lower())
+                if words is None:
+                    raise ValueError('Unknown synonym {}'.format(part))
+                word = '({})'.format('|'.join(map(re.escape, words)))
+            else:
+                word = re.escape(part.lower())
+            items.append('(?:^| ){}(?= |$)'.format(word))
+        return re.compile(''.join(items), re.I)
+
+    def match(self, text):
+        """Match text, return list of matched parts or None."""
+        if self.regex is None:
+            self.regex = self.compile()
+        match_ = self.regex.fullmatch(text)
+        if match_:
+            return [group.strip() for group in match_.groups()]
+
+    def reasmb(self):
+        """Get next reassembly rule, they are used in turn."""
+        reasmb = self.reasmbs[self.next_reasmb % len(self.reasmbs)]
+        self.next_reasmb += 1
+        return reasmb
+
+
+class Key:
+    """Keyword with rank and decomposition rules."""
+
+    def __init__(self, word, rank):
+        self.word = word
+        self.rank = rank
+        self.decomps = []
+
+
+class Script:
+    """Eliza script in classic DOCTOR format.
+
+    Script has key, decomp, reasmb, synon, pre, post, initial, final
+    and quit lines. Rules are indexed by keyword, so only keys found in
+    message are tried and cost doesn't depend on script size.
+    """
+
+    def __init__(self):
+        self.initials = []
+        self.finals = []
+        self.quits = set()
+        self.pres = {}
+        self.posts = {}
+        self.synons = {}
+        self.keys = {}
+        self.memory = collections.deque(maxlen=MEMORY_SIZE)
+
+    @classmethod
+    def from_file(cls, path):
+        """Load script from file."""
+        with open(path, encoding='utf-8') as f:
+            return cls.parse(f)
+
+    @classmethod
+    def parse(cls, lines):
+        """Parse script lines, raises ValueError on syntax errors."""
+        script = cls()
+        key = None
+        decomp = None
+        for number, line in enumerate(lines, 1):
+            line = line.strip()
+            if not line or line.startswith('#') or ':' not in line:
+                continue
+            tag, content = (i.strip() for i in line.split(':', 1))
+            words = content.split()
+            if tag == 'initial':
+                script.initials.append(content)
+            elif tag == 'final':
+                script.finals.append(content)
+            elif tag == 'quit':
+                script.quits.add(content.lower())
+            elif tag in ('pre', 'post') and len(words) > 1:
+                subs = script.pres if tag == 'pre' else script.posts
+                subs[words[0].lower()] = [w.lower() for w in words[1:]]
+            elif tag == 'synon' and words:
+                script.synons[words[0].lower()] = [w.lower() for w in words]
+            elif tag == 'key' and words:
+                rank = int(words[1]) if len(words) > 1 else 1
+                key = script.keys[words[0].lower()] = Key(words[0].lower(),
+                                                          rank)
+                decomp = None
+            elif tag == 'decomp' and key is not None and words:
+                save = words[0] == '$'
+                if save:
+                    words = words[1:]
+                decomp = Decomp(words, save, script)
+                key.decomps.append(decomp)
+            elif tag == 'reasmb' and decomp is not None:
+                decomp.reasmbs.append(content)
+            else:
+                raise ValueError('Bad line {}: {}'.format(number, line))
+        for key in script.keys.values():
+            key.decomps = [d for d in key.decomps if d.reasmbs]
+        return script
+
+    def substitute(self, words, subs):
+        """Replace words using pre or post substitutions."""
+        result = []
+        for word in words:
+            result.extend(subs.get(word, (word,)))
+        return result
+
+    def reassemble(self, reasmb, results):
+        """Put matched parts into reassembly rule."""
+        def replace(match_):
+            number = int(match_.group(1))
+            if number < 1 or number > len(results):
+                return ''
+            words = self.substitute(results[number - 1].split(), self.posts)
+            # Only text before punctuation is used
+            for i, word in enumerate(words):
+                if word in ('.', ',', ';', '!', '?'):
+                    words = words[:i]
+                    break
+            return ' '.join(words)
+        return REFERENCE_RE.sub(replace, reasmb)
+
+    def match_key(self, text, key, depth=0):
+        """Try decomposition rules of key, return answer or None."""
+        for decomp in key.decomps:
+            try:
+                results = decomp.match(text)
+            except ValueError:
+                logger.exception('Bad decomp rule of key %s', key.word)
+                continue
+            if results is None:
+                continue
+            reasmb = decomp.reasmb()
+            if reasmb.startswith('goto '):
+                target = self.keys.get(reasmb[len('goto '):].strip().lower())
+                if target is None or depth > len(self.keys):
+                    return None
+                return self.match_key(text, target, depth + 1)
+            answer = self.reassemble(reasmb, results)
+            if decomp.save:
+                self.memory.append(answer)
+                continue
+            return answer
+        return None
+
+    def respond(self, message):
+        """Get answer for message or None."""
+        text = PUNCTUATION_RE.sub(r' \1 ', message.lower()).strip()
+        if text in self.quits:
+            return random.choice(self.finals) if self.finals else None
+        words = self.substitute(text.split(), self.pres)
+        text = ' '.join(words)
+        keys = []
+        for word in dict.fromkeys(words):
+            key = self.keys.get(word)
+            if key is not None:
+                keys.append(key)
+        # Stable sort keeps message order for equal ranks
+        keys.sort(key=lambda k: -k.rank)
+        for key in keys:
+            answer = self.match_key(text, key)
+            if answer:
+                return answer
+        if self.memory:
+            return self.memory.popleft()
+        xnone = self.keys.get('xnone')
+        if xnone is not None:
+            return self.match_key(text, xnone)
+        return None
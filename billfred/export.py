@@ -0,0 +1,188 @@
+import sys
+import csv
+import json
+import html
+import time
+import asyncio
+import argparse
+import configparser
+from datetime import datetime, timezone
+
+from billfred.database import Database, database_options
+
+
+HTML_HEADER = '''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<style>
+body {{ font-family: monospace; }}
+td {{ padding: 0 0.5em; vertical-align: top; }}
+.time {{ color: #888; white-space: nowrap; }}
+.nick {{ font-weight: bold; white-space: nowrap; }}
+.message {{ white-space: pre-wrap; }}
+</style>
+</head>
+<body>
+<h1>{title}</h1>
+<table>
+'''
+HTML_ROW = ('<tr id="m{}"><td class="time">{}</td>'
+            '<td class="nick">{}</td><td class="message">{}</td></tr>\n')
+HTML_FOOTER = '''</table>
+</body>
+</html>
+'''
+FIELDS = ('id', 'time', 'jid', 'nick', 'message')
+
+
+def parse_time(value):
+    """Parse unix timestamp or ISO date into timestamp."""
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+def format_time(timestamp):
+    """Format timestamp for humans."""
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(timestamp))
+
+
+class JsonlWriter:
+    """Write rows as JSON lines."""
+
+    def __init__(self, out, title):
+        self.out = out
+
+    def write(self, row):
+        self.out.write(json.dumps(dict(zip(FIELDS, row)),
+                                  ensure_ascii=False))
+        self.out.write('\n')
+
+    def close(self):
+        pass
+
+
+class CsvWriter:
+    """Write rows as CSV with header."""
+
+    def __init__(self, out, title):
+        self.writer = csv.writer(out)
+        self.writer.writerow(FIELDS)
+
+    def write(self, row):
+        self.writer.writerow(row)
+
+    def close(self):
+        pass
+
+
+class HtmlWriter:
+    """Write rows as static HTML page."""
+
+    def __init__(self, out, title):
+        self.out = out
+        self.out.write(HTML_HEADER.format(title=html.escape(title)))
+
+    def write(self, row):
+        id_, time_, _, nick, message = row
+        self.out.write(HTML_ROW.format(id_,
+                                       format_time(time_),
+                                       html.escape(nick),
+                                       html.escape(message or '')))
+
+    def close(self):
+        self.out.write(HTML_FOOTER)
+
+
+WRITERS = {
+    'jsonl': JsonlWriter,
+    'csv': CsvWriter,
+    'html': HtmlWriter,
+}
+
+
+async def export(db, writer, since=None, until=None, nick=None):
+    """Write chat log rows, return number of exported rows."""
+    count = 0
+    async for row in db.iter_log(since, until, nick):
+        writer.write(row)
+        count += 1
+    writer.close()
+    return count
+
+
+def main():
+    """Export chat log to file."""
+    parser = argparse.ArgumentParser(description='Export bot chat log.')
+    parser.add_argument(
+        '--config',
+        default='billfred.cfg',
+        help='path to config file'
+    )
+    parser.add_argument(
+        '--database',
+        help='path to database, overrides config'
+    )
+    parser.add_argument(
+        '--format',
+        choices=sorted(WRITERS),
+        default='jsonl',
+        help='output format'
+    )
+    parser.add_argument(
+        '--output',
+        default='-',
+        help='output file, stdout by default'
+    )
+    parser.add_argument(
+        '--since',
+        type=parse_time,
+        help='start time, unix timestamp or ISO date (UTC by default)'
+    )
+    parser.add_argument(
+        '--until',
+        type=parse_time,
+        help='end time (exclusive), unix timestamp or ISO date'
+    )
+    parser.add_argument(
+        '--nick',
+        help='export only messages from this nick'
+    )
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    path, options = None, None
+    if 'account' in config:
+        path, options = database_options(config)
+    if args.database:
+        path = args.database
+    if not path:
+        sys.exit('Database path is not specified')
+
+    out = sys.stdout
+    if args.output != '-':
+        out = open(args.output, 'w', encoding='utf-8', newline='')
+    start = time.perf_counter()
+    try:
+        writer = WRITERS[args.format](out, 'Chat log')
+        count = asyncio.run(export(Database(path, options), writer,
+                                   args.since, args.until, args.nick))
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    elapsed = time.perf_counter() - start
+    print('Exported {} rows in {:.2f} s, {:.0f} rows/s'.format(
+        count, elapsed, count / elapsed if elapsed else 0
+    ), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
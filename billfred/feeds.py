@@ -1,12 +1,41 @@
+import re
+import sys
+import time
+import heapq
+import random
 import asyncio
+import calendar
 import feedparser
 import logging
+import multiprocessing
 from io import StringIO
+from datetime import datetime, timezone
+from urllib.parse import urljoin
 from html.parser import HTMLParser
+from email.utils import parsedate_to_datetime, parsedate_tz, mktime_tz
+from xml.etree.ElementTree import XMLPullParser, ParseError
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from billfred.httpclient import NET_ERRORS
+from billfred.outbox import PRIORITY_FEED
 
 logger = logging.getLogger(__name__)
 
-last_dates = {}
+# Number of remembered entry ids for every feed
+SEEN_LIMIT = 1000
+MAX_AGE_RE = re.compile(r'max-age=(\d+)')
+# Parser pool defaults
+WORKERS = 5
+MAX_TASKS_PER_CHILD = 100
+# Streaming reader settings
+STREAM_CHUNK_SIZE = 64 * 1024
+ATOM = '{http://www.w3.org/2005/Atom}'
+RSS_CONTENT = '{http://purl.org/rss/1.0/modules/content/}encoded'
+DC_DATE = '{http://purl.org/dc/elements/1.1/}date'
+ATOM_TYPES = {
+    'html': 'text/html',
+    'xhtml': 'application/xhtml+xml',
+}
 
 
 class TagsStripper(HTMLParser):
@@ -35,68 +64,635 @@ def strip_html(data):
     return stripper.get_data()
 
 
-def process_feed(prefix, url, show_body=False):
-    """Download feed and return new entries."""
-    logger.info('Downloading feed %s %s', prefix, url)
-    feed = feedparser.parse(url)
-    # Check errors
-    if feed.bozo:
-        logger.error('Feed %s error: %s', prefix, feed.bozo_exception)
-        return
-
-    last_date = last_dates.get(prefix)
-    # First run - do nothing but save last seen entry date
-    if last_date is None:
-        if len(feed.entries):
-            last_dates[prefix] = max([
-                e.updated_parsed for e in feed.entries
-            ])
-        else:
-            logger.info('No entries in %s %s', prefix, url)
-        return
+def entry_id(entry):
+    """Get unique entry id."""
+    return entry.get('id') or entry.get('link') or entry.get('title')
 
-    max_date = last_date
-    entries = []
-    for entry in feed.entries:
-        if entry.updated_parsed <= last_date:
-            logger.debug('Entry has no date %s', entry)
-            continue
-        if entry.updated_parsed > max_date:
-            max_date = entry.updated_parsed
-        result = '{}: {} {}'.format(prefix, entry.title, entry.link)
-        if show_body:
-            content = []
-            if entry.get('summary') and entry.get('summary_detail'):
-                text = entry.summary
-                if entry.summary_detail['type'] == 'text/html':
+
+def entry_date(entry):
+    """Get entry timestamp or None."""
+    parsed = entry.get('updated_parsed') or entry.get('published_parsed')
+    if parsed:
+        return calendar.timegm(parsed)
+
+
+def format_entry(prefix, entry, show_body):
+    """Format entry for bot message."""
+    result = '{}: {} {}'.format(prefix, entry.get('title'), entry.get('link'))
+    if show_body:
+        content = []
+        if entry.get('summary') and entry.get('summary_detail'):
+            text = entry.summary
+            if entry.summary_detail['type'] == 'text/html':
+                text = strip_html(text)
+            content.append(text)
+        if 'content' in entry:
+            for i in entry.content:
+                text = i.get('value')
+                if i.get('type') == 'text/html':
                     text = strip_html(text)
                 content.append(text)
-            if 'content' in entry:
-                for i in entry.content:
-                    text = i.get('value')
-                    if i.get('type') == 'text/html':
-                        text = strip_html(text)
-                    content.append(text)
-            if content:
-                result += '\n\n{}\n'.format('\n'.join(content))
-        entries.append(result)
-
-    last_dates[prefix] = max_date
-    logger.info('Feed %s processed, %s new entries', prefix, len(entries))
-    return entries
-
-
-async def feed_checker(client, task):
-    """Run periodic feed check."""
-    while True:
+        if content:
+            result += '\n\n{}\n'.format('\n'.join(content))
+    return result
+
+
+def entries_ordered(entries):
+    """Check that all entries are dated and go from newest to oldest."""
+    dates = [entry_date(entry) for entry in entries]
+    if None in dates:
+        return False
+    return all(a >= b for a, b in zip(dates, dates[1:]))
+
+
+def parse_timestamp(value):
+    """Parse RFC 822 or ISO 8601 date, return timestamp or None."""
+    value = value.strip()
+    parsed = parsedate_tz(value)
+    if parsed:
+        return mktime_tz(parsed)
+    try:
+        date = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return date.timestamp()
+
+
+def set_date(entry, key, value):
+    """Set parsed date of entry like feedparser does."""
+    if value:
+        timestamp = parse_timestamp(value)
+        if timestamp is not None:
+            entry[key] = time.gmtime(timestamp)
+
+
+def element_text(elem):
+    """Get text of element with text of all its children."""
+    return ''.join(elem.itertext()).strip()
+
+
+def rss_entry(elem, base):
+    """Convert RSS 2.0 item element to feedparser-like entry."""
+    entry = feedparser.FeedParserDict()
+    for child in elem:
+        if child.tag == 'title':
+            entry['title'] = element_text(child)
+        elif child.tag == 'link':
+            entry['link'] = urljoin(base, element_text(child))
+        elif child.tag == 'guid':
+            entry['id'] = element_text(child)
+            if child.get('isPermaLink') != 'false':
+                entry['id'] = urljoin(base, entry['id'])
+        elif child.tag == 'pubDate':
+            set_date(entry, 'published_parsed', child.text)
+        elif child.tag == DC_DATE:
+            set_date(entry, 'updated_parsed', child.text)
+        elif child.tag == 'description':
+            entry['summary'] = child.text or ''
+            entry['summary_detail'] = {'type': 'text/html'}
+        elif child.tag == RSS_CONTENT:
+            entry.setdefault('content', []).append({
+                'type': 'text/html',
+                'value': child.text or '',
+            })
+    return entry
+
+
+def atom_text(elem):
+    """Get Atom text construct as dict with type and value."""
+    kind = ATOM_TYPES.get(elem.get('type'), 'text/plain')
+    if kind == 'application/xhtml+xml':
+        # Markup is parsed as elements, keep only text
+        return {'type': 'text/plain', 'value': element_text(elem)}
+    return {'type': kind, 'value': elem.text or ''}
+
+
+def atom_entry(elem, base):
+    """Convert Atom entry element to feedparser-like entry."""
+    entry = feedparser.FeedParserDict()
+    for child in elem:
+        if child.tag == ATOM + 'title':
+            entry['title'] = element_text(child)
+        elif child.tag == ATOM + 'link':
+            if (child.get('rel', 'alternate') == 'alternate' and
+                    'link' not in entry):
+                entry['link'] = urljoin(base, child.get('href', ''))
+        elif child.tag == ATOM + 'id':
+            entry['id'] = element_text(child)
+        elif child.tag == ATOM + 'updated':
+            set_date(entry, 'updated_parsed', child.text)
+        elif child.tag == ATOM + 'published':
+            set_date(entry, 'published_parsed', child.text)
+        elif child.tag == ATOM + 'summary':
+            text = atom_text(child)
+            entry['summary'] = text['value']
+            entry['summary_detail'] = {'type': text['type']}
+        elif child.tag == ATOM + 'content':
+            entry.setdefault('content', []).append(atom_text(child))
+    return entry
+
+
+class EntryStream:
+    """Read new entries of ordered feed while it's downloaded.
+
+    Chunks of RSS 2.0 or Atom document are fed as they come and entries
+    are removed from the tree when they are read, so memory depends on
+    number of new entries, not on feed size. Reading stops at the first
+    seen entry. Stream fails if feed is malformed, isn't RSS 2.0 or Atom
+    or has undated or unordered entries.
+    """
+
+    def __init__(self, seen, base=None):
+        self.seen = seen
+        self.base = base
+        self.parser = XMLPullParser(events=('start', 'end'))
+        self.stack = []
+        self.entries = []
+        self.last_date = None
+        self.done = False
+        self.failed = False
+
+    def feed(self, data):
+        """Feed next chunk, returns True when reading can stop."""
+        try:
+            self.parser.feed(data)
+            self.read_events()
+        except (ParseError, ValueError):
+            self.failed = True
+        return self.done or self.failed
+
+    def close(self):
+        """Finish reading, returns new entries from newest to oldest.
+
+        Returns None if stream failed or no seen entry was found, then
+        either all entries are new or ids differ from feedparser ones.
+        """
+        if not self.done and not self.failed:
+            try:
+                self.parser.close()
+                self.read_events()
+            except (ParseError, ValueError):
+                self.failed = True
+        if self.failed or not self.done:
+            return None
+        return self.entries
+
+    def read_events(self):
+        """Handle parsed elements, raises ValueError for unknown format."""
+        for event, elem in self.parser.read_events():
+            if self.done or self.failed:
+                return
+            if event == 'start':
+                if not self.stack and elem.tag not in ('rss', ATOM + 'feed'):
+                    raise ValueError('Unsupported feed root {}'.format(
+                        elem.tag))
+                self.stack.append(elem)
+                continue
+            self.stack.pop()
+            if not self.stack:
+                continue
+            parent = self.stack[-1]
+            if elem.tag == 'item' and parent.tag == 'channel':
+                self.add(rss_entry(elem, self.base))
+            elif elem.tag == ATOM + 'entry' and len(self.stack) == 1:
+                self.add(atom_entry(elem, self.base))
+            else:
+                continue
+            parent.remove(elem)
+
+    def add(self, entry):
+        """Check entry and remember it if it's new."""
+        date = entry_date(entry)
+        if date is None or (self.last_date is not None and
+                            date > self.last_date):
+            self.failed = True
+            return
+        self.last_date = date
+        guid = entry_id(entry)
+        if guid in self.seen:
+            self.done = True
+        elif guid is not None:
+            self.entries.append(entry)
+
+
+def process_feed(prefix, data, headers, show_body=False, state=None,
+                 feed_entries=None):
+    """Parse downloaded feed and return new entries.
+
+    Returns tuple of new entry messages, updated state without seen ids
+    and ids of new entries from oldest to newest. If state is None, feed
+    is checked for the first time, so entries are only remembered. State
+    in result is None if feed can't be parsed, so it's not saved. Entries
+    that were read while feed was streamed are passed as feed_entries,
+    data isn't parsed then. Runs in thread or process pool, so arguments
+    and result are kept small.
+    """
+    new_state = {
+        'last_date': None,
+        'etag': None,
+        'modified': None,
+        'ordered': False,
+        'seen': set(),
+    }
+    if state is not None:
+        new_state.update(state)
+    seen = new_state.pop('seen')
+    if feed_entries is None:
+        feed = feedparser.parse(data, response_headers=headers)
+        # Check errors
+        if feed.bozo:
+            logger.error('Feed %s error: %s', prefix, feed.bozo_exception)
+            # Empty state of broken first poll would announce everything
+            return [], None, []
+        feed_entries = feed.entries
+        new_state['ordered'] = entries_ordered(feed_entries)
+    new_state['etag'] = headers.get('etag')
+    new_state['modified'] = headers.get('last-modified')
+
+    entries = []
+    new_ids = []
+    for entry in feed_entries:
+        guid = entry_id(entry)
+        if guid is None:
+            continue
+        if guid in seen:
+            if new_state['ordered']:
+                # Everything after known entry was seen before
+                break
+            continue
+        date = entry_date(entry)
+        new_ids.append((date, guid))
+        if date is not None and (new_state['last_date'] is None or
+                                 date > new_state['last_date']):
+            new_state['last_date'] = date
+        if state is not None:
+            entries.append(format_entry(prefix, entry, show_body))
+
+    if state is None:
+        logger.info('Feed %s checked first time, %s entries remembered',
+                    prefix, len(new_ids))
+    else:
+        logger.info('Feed %s processed, %s new entries',
+                    prefix, len(entries))
+    # Oldest ids go first, so the newest are kept when ids are trimmed.
+    # Undated entries count as newest, feed order is kept for them.
+    new_ids.reverse()
+    new_ids.sort(key=lambda item: (item[0] is None, item[0] or 0))
+    return entries, new_state, [guid for _, guid in new_ids]
+
+
+async def fetch_feed(client, url, state):
+    """Download feed with conditional request.
+
+    Returns tuple of response status, body, headers with lowercase names,
+    number of bytes received and streamed entries. Ordered feeds with
+    known entries are streamed and download stops at the first seen
+    entry, then streamed entries are new ones and body is None. If feed
+    can't be streamed, the rest of it is downloaded and full body is
+    returned with None entries. Body and entries are None if feed wasn't
+    modified or on error status.
+    Compressed responses are accepted, gzip and deflate always, brotli
+    if it's installed.
+    """
+    headers = {}
+    if state is not None:
+        if state['etag']:
+            headers['If-None-Match'] = state['etag']
+        if state['modified']:
+            headers['If-Modified-Since'] = state['modified']
+    async with client.http.get(url, headers=headers) as r:
+        response_headers = {k.lower(): v for k, v in r.headers.items()}
+        response_headers['content-location'] = str(r.url)
+        if r.status == 304 or r.status >= 400:
+            return r.status, None, response_headers, 0, None
+        chunks = []
+        if state is not None and state['ordered'] and state['seen']:
+            stream = EntryStream(state['seen'], str(r.url))
+            async for chunk in r.content.iter_chunked(STREAM_CHUNK_SIZE):
+                chunks.append(chunk)
+                if stream.feed(chunk):
+                    break
+            entries = stream.close()
+            if entries is not None:
+                size = sum(len(chunk) for chunk in chunks)
+                return r.status, None, response_headers, size, entries
+            logger.info('Feed %s can\'t be streamed, reading it whole', url)
+        chunks.append(await r.content.read())
+        data = b''.join(chunks)
+        # Content-Length is size of compressed body
+        return (r.status, data, response_headers,
+                r.content_length or len(data), None)
+
+
+def update_stats(task, status, size, parse_time):
+    """Update feed stats and return them."""
+    stats = task.setdefault('stats', {
+        'polls': 0,
+        'not_modified': 0,
+        'bytes': 0,
+        'parses': 0,
+        'parse_time': 0.0,
+    })
+    stats['polls'] += 1
+    stats['bytes'] += size
+    if status == 304:
+        stats['not_modified'] += 1
+    if parse_time is not None:
+        stats['parses'] += 1
+        stats['parse_time'] += parse_time
+    return stats
+
+
+def header_delay(headers):
+    """Get minimal delay before next poll from response headers.
+
+    Retry-After and Cache-Control max-age or Expires are supported.
+    """
+    value = headers.get('retry-after')
+    if value:
+        if value.strip().isdigit():
+            return int(value)
+        return http_date_delay(value)
+    match = MAX_AGE_RE.search(headers.get('cache-control', ''))
+    if match:
+        return int(match.group(1))
+    if headers.get('expires'):
+        return http_date_delay(headers['expires'])
+    return 0
+
+
+def http_date_delay(value):
+    """Get seconds until HTTP date, 0 if date is invalid."""
+    try:
+        return max(0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return 0
+
+
+def create_pool(options=None):
+    """Create executor for feed parsing.
+
+    Parsing is CPU heavy, with parser = process it runs in separate
+    processes and doesn't hold GIL of the main one. Process workers are
+    restarted after max_tasks_per_child parses. Workers are started with
+    forkserver or spawn, forked ones would inherit threads of the bot.
+    """
+    parser = 'thread'
+    workers = WORKERS
+    max_tasks = MAX_TASKS_PER_CHILD
+    if options:
+        parser = options.get('parser', parser)
+        if options.get('workers') is not None:
+            workers = max(1, int(options['workers']))
+        if options.get('max_tasks_per_child') is not None:
+            max_tasks = int(options['max_tasks_per_child']) or None
+    if parser == 'process':
+        logger.info('Parsing feeds in %s processes', workers)
+        methods = multiprocessing.get_all_start_methods()
+        method = 'forkserver' if 'forkserver' in methods else 'spawn'
+        kwargs = {'mp_context': multiprocessing.get_context(method)}
+        if max_tasks and sys.version_info >= (3, 11):
+            kwargs['max_tasks_per_child'] = max_tasks
+        return ProcessPoolExecutor(max_workers=workers, **kwargs)
+    if parser != 'thread':
+        logger.warning('Unknown feed parser mode %s, using threads', parser)
+    return ThreadPoolExecutor(max_workers=workers)
+
+
+class FeedScheduler:
+    """Poll all feeds from one task.
+
+    Next poll times are kept in a heap. Poll interval of every feed
+    adapts to its update frequency between min_time and max_time, failed
+    feeds are polled with exponential backoff.
+    """
+    CONCURRENCY = 5
+    JITTER = 60
+    MAX_TIME_FACTOR = 8
+    MAX_BACKOFF = 60 * 60 * 6
+
+    def __init__(self, client, feeds, pool, options=None):
+        self.client = client
+        self.feeds = feeds
+        self.pool = pool
+        self.concurrency = self.CONCURRENCY
+        self.jitter = self.JITTER
+        self.max_backoff = self.MAX_BACKOFF
+        if options:
+            if options.get('concurrency') is not None:
+                self.concurrency = max(1, int(options['concurrency']))
+            if options.get('jitter') is not None:
+                self.jitter = int(options['jitter'])
+            if options.get('max_backoff') is not None:
+                self.max_backoff = int(options['max_backoff'])
+        for feed in feeds:
+            feed.setdefault('min_time', feed['time'])
+            feed.setdefault('max_time', feed['time'] * self.MAX_TIME_FACTOR)
+            feed['interval'] = feed['time']
+            feed['failures'] = 0
+            feed['update_gap'] = None
+            feed['last_update'] = None
+        self.heap = []
+        self.wakeup = None
+        self.semaphore = None
+        self.task = None
+        self.polls = set()
+
+    def start(self):
+        """Schedule first polls with random delays and start."""
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        self.heap = []
+        for seq, feed in enumerate(self.feeds):
+            delay = random.uniform(0, min(self.jitter, feed['time']))
+            self.heap.append((now + delay, seq, feed))
+        heapq.heapify(self.heap)
+        self.wakeup = asyncio.Event()
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.task = self.client.create_task(self.run())
+
+    async def stop(self):
+        """Stop scheduler and running polls."""
+        tasks = list(self.polls)
+        if self.task:
+            tasks.append(self.task)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.task = None
+
+    async def run(self):
+        """Start polls when they are due."""
+        loop = asyncio.get_running_loop()
+        while self.heap or self.polls:
+            delay = self.heap[0][0] - loop.time() if self.heap else None
+            if delay is None or delay > 0:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self.semaphore.acquire()
+            _, seq, feed = heapq.heappop(self.heap)
+            task = self.client.create_task(self.poll(seq, feed))
+            self.polls.add(task)
+            task.add_done_callback(self.polls.discard)
+
+    async def poll(self, seq, feed):
+        """Check feed and schedule next poll."""
+        delay = None
+        try:
+            delay = await self.check(feed)
+        finally:
+            self.semaphore.release()
+            if delay is None:
+                delay = self.backoff(feed)
+            logger.debug('Next poll of %s in %.0f s', feed['prefix'], delay)
+            loop = asyncio.get_running_loop()
+            heapq.heappush(self.heap, (loop.time() + delay, seq, feed))
+            self.wakeup.set()
+
+    def backoff(self, feed):
+        """Count failure and get delay before retry."""
+        feed['failures'] += 1
+        return min(feed['interval'] * 2 ** feed['failures'], self.max_backoff)
+
+    def adapt(self, feed, new_entries):
+        """Update poll interval from observed update frequency."""
+        if new_entries:
+            now = time.time()
+            if feed['last_update'] is not None:
+                gap = now - feed['last_update']
+                if feed['update_gap'] is None:
+                    feed['update_gap'] = gap
+                else:
+                    feed['update_gap'] = 0.7 * feed['update_gap'] + 0.3 * gap
+                # Poll twice per average update period
+                feed['interval'] = feed['update_gap'] / 2
+            else:
+                feed['interval'] = feed['interval'] / 2
+            feed['last_update'] = now
+        else:
+            feed['interval'] = feed['interval'] * 1.25
+        feed['interval'] = min(max(feed['interval'], feed['min_time']),
+                               feed['max_time'])
+        return feed['interval']
+
+    async def check(self, feed):
+        """Poll feed and announce new entries.
+
+        Returns delay before next poll, None on failure.
+        """
+        client = self.client
         try:
             loop = asyncio.get_running_loop()
-            entries = await loop.run_in_executor(
-                client.feed_pool, process_feed,
-                task['prefix'], task['url'], task['show_body']
+            state = await client.db.get_feed_state(feed['url'])
+            logger.info('Downloading feed %s %s', feed['prefix'], feed['url'])
+            status, data, headers, size, streamed = await fetch_feed(
+                client, feed['url'], state
+            )
+            entries = []
+            parse_time = None
+            if status >= 400:
+                logger.error('Feed %s error status: %s',
+                             feed['prefix'], status)
+            elif data is None and streamed is None:
+                logger.info('Feed %s not modified', feed['prefix'])
+            else:
+                start = time.perf_counter()
+                entries, state, new_ids = await loop.run_in_executor(
+                    self.pool, process_feed, feed['prefix'], data,
+                    headers, feed['show_body'], state, streamed
+                )
+                parse_time = time.perf_counter() - start
+                if state is not None:
+                    await client.db.save_feed_state(feed['url'], state,
+                                                    new_ids, SEEN_LIMIT)
+                # Outbox joins short entries and splits long ones
+                for entry in entries:
+                    client.send_bot_message({
+                        'message': entry,
+                        'priority': PRIORITY_FEED
+                    })
+            stats = update_stats(feed, status, size, parse_time)
+            logger.info(
+                'Feed %s stats: status %s, %s bytes, parse %.1f ms; '
+                'total %s polls, %.0f%% not modified, %s bytes, '
+                'average parse %.1f ms',
+                feed['prefix'], status, size, (parse_time or 0) * 1000,
+                stats['polls'],
+                stats['not_modified'] / stats['polls'] * 100,
+                stats['bytes'],
+                stats['parse_time'] / (stats['parses'] or 1) * 1000
             )
-            if entries:
-                client.send_bot_message({'message': '\n'.join(entries)})
+        except NET_ERRORS as e:
+            logger.error('Feed %s net error: %r', feed['prefix'], e)
+            return None
         except Exception:
             logger.exception('Feed thread error')
-        await asyncio.sleep(task['time'])
+            return None
+        if status >= 400:
+            # Server may ask to wait longer than backoff
+            return max(self.backoff(feed),
+                       min(header_delay(headers), self.max_backoff))
+        feed['failures'] = 0
+        interval = self.adapt(feed, bool(entries))
+        return min(max(interval, header_delay(headers)), feed['max_time'])
+
+
+class Feeds:
+    """Announce new entries of feeds from rss_* config sections."""
+
+    def __init__(self, client):
+        self.client = client
+        conf = client.config
+        self.options = conf['feeds'] if 'feeds' in conf else None
+        self.pool = None
+        self.scheduler = None
+
+    def read_feeds(self):
+        """Get feed settings from config."""
+        feeds = []
+        for section in self.client.config.sections():
+            if section.startswith('rss_'):
+                c = self.client.config[section]
+                task = {
+                    'prefix': c['prefix'],
+                    'url': c['url'],
+                    'time': int(c['time']),
+                    'show_body': c.getboolean('show_body', True)
+                }
+                if c.get('min_time'):
+                    task['min_time'] = int(c['min_time'])
+                if c.get('max_time'):
+                    task['max_time'] = int(c['max_time'])
+                logger.info('Adding feed %s', task['url'])
+                feeds.append(task)
+        return feeds
+
+    def start(self):
+        """Initialize feed scheduler and start initial run."""
+        logger.info('Initializing feeds')
+        if self.pool is None:
+            # Pool is kept between reconnects
+            self.pool = create_pool(self.options)
+        self.scheduler = FeedScheduler(self.client, self.read_feeds(),
+                                       self.pool, self.options)
+        self.scheduler.start()
+        logger.info('Finished feeds initialization')
+
+    async def close(self):
+        """Stop feed scheduler, pool is kept for reconnect."""
+        if self.scheduler is not None:
+            await self.scheduler.stop()
+            self.scheduler = None
+
+    def shutdown(self):
+        """Stop parser pool before exit."""
+        if self.pool is not None:
+            logger.info('Shutting down feed parser pool')
+            self.pool.shutdown(wait=False)
+            self.pool = None
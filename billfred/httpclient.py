@@ -0,0 +1,110 @@
+import asyncio
+import logging
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+
+class HttpClient:
+    """Shared HTTP client for bot subsystems.
+
+    Owns one session with one connection pool, so keep-alive connections
+    and DNS cache are shared. Session is created on first request or
+    open() and destroyed on close(), it can be reopened after reconnect.
+    """
+    LIMIT = 100
+    LIMIT_PER_HOST = 4
+    DNS_TTL = 300
+    KEEPALIVE_TIMEOUT = 30
+    TIMEOUT = 30
+    CONNECT_TIMEOUT = 10
+
+    def __init__(self, client):
+        config = client.config
+        self.session = None
+        self.user_agent = client.user_agent
+        self.limit = self.LIMIT
+        self.limit_per_host = self.LIMIT_PER_HOST
+        self.dns_ttl = self.DNS_TTL
+        self.keepalive_timeout = self.KEEPALIVE_TIMEOUT
+        self.timeout = self.TIMEOUT
+        self.connect_timeout = self.CONNECT_TIMEOUT
+        if 'http' in config:
+            c = config['http']
+            if c.get('limit') is not None:
+                self.limit = int(c['limit'])
+            if c.get('limit_per_host') is not None:
+                self.limit_per_host = int(c['limit_per_host'])
+            if c.get('dns_ttl') is not None:
+                self.dns_ttl = int(c['dns_ttl'])
+            if c.get('keepalive_timeout') is not None:
+                self.keepalive_timeout = float(c['keepalive_timeout'])
+            if c.get('timeout') is not None:
+                self.timeout = float(c['timeout'])
+            if c.get('connect_timeout') is not None:
+                self.connect_timeout = float(c['connect_timeout'])
+            if c.get('user_agent'):
+                self.user_agent = c['user_agent']
+        self.stats = {
+            'requests': 0,
+            'connections_created': 0,
+            'connections_reused': 0,
+            'dns_cache_hits': 0,
+            'dns_cache_misses': 0,
+        }
+
+    def trace_config(self):
+        """Create trace config that counts connection reuse."""
+        def counter(name):
+            async def count(session, context, params):
+                self.stats[name] += 1
+            return count
+
+        trace = aiohttp.TraceConfig()
+        trace.on_request_start.append(counter('requests'))
+        trace.on_connection_create_end.append(
+            counter('connections_created')
+        )
+        trace.on_connection_reuseconn.append(counter('connections_reused'))
+        trace.on_dns_cache_hit.append(counter('dns_cache_hits'))
+        trace.on_dns_cache_miss.append(counter('dns_cache_misses'))
+        return trace
+
+    async def open(self):
+        """Create session, close old one if any."""
+        await self.close()
+        self.create_session()
+
+    def create_session(self):
+        """Create session with shared connection pool."""
+        logger.info('Creating HTTP session')
+        connector = aiohttp.TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            ttl_dns_cache=self.dns_ttl,
+            keepalive_timeout=self.keepalive_timeout,
+        )
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=self.timeout,
+                                          connect=self.connect_timeout),
+            headers={'User-Agent': self.user_agent},
+            trace_configs=[self.trace_config()],
+        )
+
+    async def close(self):
+        """Destroy session."""
+        if self.session:
+            logger.info('Destroying HTTP session, stats: %s', self.stats)
+            await self.session.close()
+            self.session = None
+
+    def get(self, url, **kwargs):
+        """Make GET request, use as async context manager."""
+        if self.session is None:
+            self.create_session()
+        return self.session.get(url, **kwargs)
+
+
+# Errors that mean that request failed because of network
+NET_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError)
@@ -1,46 +1,246 @@
+import time
 import asyncio
-import aiohttp
-import codecs
+import contextlib
+import collections
 import cgi
+import html
+import json
 import logging
 import re
 from charset_normalizer import detect
-from urllib.parse import urlsplit
-from html.parser import HTMLParser
+from urllib.parse import (
+    urlsplit, urlunsplit, parse_qsl, urlencode, unquote
+)
+
+from billfred.cache import Cache
+from billfred.httpclient import NET_ERRORS
+from billfred.outbox import PRIORITY_LINK
+from billfred.ratelimit import TokenBucket
 
 logger = logging.getLogger(__name__)
 
 
-class TitleParser(HTMLParser):
-    """HTML parser that extracts titles from page."""
+TRACKING_PARAMS = {
+    'fbclid', 'gclid', 'yclid', 'dclid', 'msclkid', 'igshid',
+    'mc_cid', 'mc_eid', '_openstat', 'ref_src',
+}
+
+
+def normalize_url(url):
+    """Normalize URL for using as cache key.
+
+    Scheme and host are lowercased, fragment and tracking parameters
+    are removed.
+    """
+    parts = urlsplit(url)
+    query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+             if not k.startswith('utm_') and k not in TRACKING_PARAMS]
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(),
+                       parts.path or '/', urlencode(query), ''))
 
-    def __init__(self, url):
-        super().__init__()
-        self.url = url
-        self.domain = url.netloc
+
+class TitleScanner:
+    """Incremental title scanner that works on raw HTML bytes.
+
+    Looks for <meta> charset declarations and <title> contents until
+    the end of <head>. Comments, scripts and styles are skipped. Only
+    title bytes are decoded.
+    """
+    TAG_RE = re.compile(
+        rb'<(meta|title|script|style)\b[^>]*>|<!--|</head|<body', re.I
+    )
+    TITLE_END_RE = re.compile(rb'</title\s*>', re.I)
+    CHARSET_RE = re.compile(rb'''charset\s*=\s*["']?\s*([\w.:-]+)''', re.I)
+    SKIP_END_RE = {
+        b'<!--': re.compile(rb'-->'),
+        b'script': re.compile(rb'</script', re.I),
+        b'style': re.compile(rb'</style', re.I),
+    }
+    # Longest skip end without its last byte
+    SKIP_TAIL = 7
+
+    def __init__(self):
+        self.buf = b''
+        self.charset = None
         self.title = None
         self.in_title = False
-        self.title_buf = []
+        self.skip_end = None
+        self.done = False
 
-    def get_title(self):
-        """Return title if ready."""
-        return self.title
+    def feed(self, data):
+        """Scan next chunk of page."""
+        if self.done:
+            return
+        self.buf += data
+        pos = 0
+        while not self.in_title:
+            if self.skip_end is not None:
+                match = self.skip_end.search(self.buf, pos)
+                if not match:
+                    # Keep end that can be split between chunks
+                    pos = max(pos, len(self.buf) - self.SKIP_TAIL)
+                    break
+                pos = match.end()
+                self.skip_end = None
+                continue
+            match = self.TAG_RE.search(self.buf, pos)
+            if not match:
+                # Keep unfinished tag for next chunk
+                start = self.buf.rfind(b'<', pos)
+                pos = start if start >= 0 else len(self.buf)
+                break
+            pos = match.end()
+            tag = match.group(1)
+            if tag is None:
+                if match.group(0) == b'<!--':
+                    self.skip_end = self.SKIP_END_RE[b'<!--']
+                    continue
+                # Title can't be after <head>
+                self.done = True
+                return
+            tag = tag.lower()
+            if tag == b'title':
+                self.in_title = True
+            elif tag != b'meta':
+                self.skip_end = self.SKIP_END_RE[tag]
+            elif self.charset is None:
+                charset = self.CHARSET_RE.search(match.group(0))
+                if charset:
+                    self.charset = charset.group(1).decode('ascii')
+        self.buf = self.buf[pos:]
+        if self.in_title:
+            match = self.TITLE_END_RE.search(self.buf)
+            if match:
+                self.title = self.buf[:match.start()]
+                self.buf = b''
+                self.done = True
 
-    def handle_starttag(self, tag, attrs):
-        """Handle start of title tag."""
-        if tag == 'title':
-            self.in_title = True
+    def get_title(self, charset=None):
+        """Decode title, charset from headers goes before meta one."""
+        if self.title is None:
+            return None
+        for encoding in (charset, self.charset):
+            if encoding is None:
+                continue
+            try:
+                text = self.title.decode(encoding, errors='ignore')
+                break
+            except LookupError:
+                logger.debug('Unknown charset %s', encoding)
+        else:
+            try:
+                # Most pages without declared charset are ASCII or UTF-8
+                text = self.title.decode('utf-8')
+            except UnicodeDecodeError:
+                detected = detect(self.title)
+                text = self.title.decode(detected['encoding'] or 'utf-8',
+                                         errors='ignore')
+        return html.unescape(text).strip()
 
-    def handle_endtag(self, tag):
-        """Handle end of title tag."""
-        if tag == 'title':
-            self.in_title = False
-            self.title = ''.join(self.title_buf)
 
-    def handle_data(self, data):
-        """Append data to title buffer."""
-        if self.in_title:
-            self.title_buf.append(data)
+class Extractor:
+    """Site specific title extractor.
+
+    Extractor is used for links with host ending with one of hosts and
+    path matching path_re. get_title returns tuple of title and number
+    of downloaded bytes, or None to fall back to generic HTML path.
+    """
+    name = None
+    hosts = ()
+    path_re = re.compile(r'')
+    # Whether extractor downloads anything and needs download slot
+    network = True
+
+    def __init__(self, links, options):
+        self.links = links
+        self.options = options
+
+    async def get_title(self, url, match):
+        """Get title of url, match is result of path_re.
+
+        Abstract, every extractor must override it.
+        """
+        raise NotImplementedError
+
+
+class WikipediaExtractor(Extractor):
+    """Build Wikipedia article title from URL."""
+    name = 'wikipedia'
+    hosts = ('wikipedia.org',)
+    path_re = re.compile(r'^/wiki/([^:]+)$')
+    network = False
+
+    async def get_title(self, url, match):
+        title = unquote(match.group(1)).replace('_', ' ')
+        return '{} - Wikipedia'.format(title), 0
+
+
+class OEmbedExtractor(Extractor):
+    """Get title from oEmbed JSON endpoint."""
+    endpoint = None
+    site = None
+
+    async def get_title(self, url, match):
+        endpoint = self.options.get('{}_endpoint'.format(self.name),
+                                    self.endpoint)
+        query = urlencode({'url': url, 'format': 'json'})
+        async with self.links.client.http.get(
+                '{}?{}'.format(endpoint, query)
+        ) as r:
+            if r.status != 200:
+                logger.debug('oEmbed error %s for %s', r.status, url)
+                return None
+            data = await r.read()
+        title = json.loads(data).get('title')
+        if not title:
+            return None
+        return '{} - {}'.format(title, self.site), len(data)
+
+
+class YoutubeExtractor(OEmbedExtractor):
+    name = 'youtube'
+    site = 'YouTube'
+    hosts = ('youtube.com', 'youtu.be')
+    path_re = re.compile(r'^/(watch|shorts/|live/|embed/|[\w-]{11}$)')
+    endpoint = 'https://www.youtube.com/oembed'
+
+
+class VimeoExtractor(OEmbedExtractor):
+    name = 'vimeo'
+    site = 'Vimeo'
+    hosts = ('vimeo.com',)
+    path_re = re.compile(r'^/\d+')
+    endpoint = 'https://vimeo.com/api/oembed.json'
+
+
+EXTRACTORS = {
+    cls.name: cls for cls in (
+        WikipediaExtractor,
+        YoutubeExtractor,
+        VimeoExtractor,
+    )
+}
+
+
+class ExtractorIndex:
+    """Find extractor for URL by host suffix and path."""
+
+    def __init__(self, extractors):
+        self.by_host = {}
+        for extractor in extractors:
+            for host in extractor.hosts:
+                self.by_host.setdefault(host, []).append(extractor)
+
+    def find(self, url):
+        """Return extractor and path match or (None, None)."""
+        parts = urlsplit(url)
+        labels = (parts.hostname or '').split('.')
+        for i in range(len(labels)):
+            for extractor in self.by_host.get('.'.join(labels[i:]), ()):
+                match = extractor.path_re.match(parts.path)
+                if match:
+                    return extractor, match
+        return None, None
 
 
 class Links:
@@ -52,16 +252,37 @@ class Links:
     )
     ALLOWED_TYPES = ('text/html', 'application/xhtml+xml')
     TOO_LONG = 1024 * 1024 * 5
-    LINK_INTERVAL = 3
+    LINK_INTERVAL = 3  # average seconds between downloads
     LINK_RE = re.compile(r'https?://[^\s]+')
-    CHUNK_SIZE = 1024
+    CHUNK_SIZE = 4096
+    MAX_CHUNK_SIZE = 65536
+    MAX_BYTES = 256 * 1024
     LINKS_LIMIT = 3
+    CACHE_SIZE = 1000
+    CACHE_TTL = 60 * 60 * 24
+    NEGATIVE_TTL = 60 * 60
+    ERROR_TTL = 60 * 5
+    CONCURRENCY = 4
+    HOST_CONCURRENCY = 2
+    DEADLINE = 20
+    REPEAT_WINDOW = 60 * 5
 
     def __init__(self, client):
         self.client = client
-        self.session = aiohttp.ClientSession()
         self.link_interval = self.LINK_INTERVAL
         self.links_limit = self.LINKS_LIMIT
+        self.cache_size = self.CACHE_SIZE
+        self.cache_ttl = self.CACHE_TTL
+        self.negative_ttl = self.NEGATIVE_TTL
+        self.error_ttl = self.ERROR_TTL
+        self.concurrency = self.CONCURRENCY
+        self.host_concurrency = self.HOST_CONCURRENCY
+        self.deadline = self.DEADLINE
+        self.burst = None
+        self.max_bytes = self.MAX_BYTES
+        self.repeat_window = self.REPEAT_WINDOW
+        extractors = list(EXTRACTORS)
+        options = {}
         self.disabled = False
         self.ignore_nicks = set()
         conf = client.config
@@ -76,12 +297,62 @@ class Links:
             if c.get('ignore_nicks'):
                 self.ignore_nicks = {i.strip() for i in
                                      c['ignore_nicks'].split()}
+            if c.get('cache_size') is not None:
+                self.cache_size = int(c['cache_size'])
+            if c.get('cache_ttl') is not None:
+                self.cache_ttl = int(c['cache_ttl'])
+            if c.get('negative_ttl') is not None:
+                self.negative_ttl = int(c['negative_ttl'])
+            if c.get('error_ttl') is not None:
+                self.error_ttl = int(c['error_ttl'])
+            if c.get('concurrency') is not None:
+                self.concurrency = max(1, int(c['concurrency']))
+            if c.get('host_concurrency') is not None:
+                self.host_concurrency = max(1, int(c['host_concurrency']))
+            if c.get('deadline') is not None:
+                self.deadline = float(c['deadline'])
+            if c.get('burst') is not None:
+                self.burst = int(c['burst'])
+            if c.get('max_bytes') is not None:
+                self.max_bytes = max(1, int(c['max_bytes']))
+            if c.get('repeat_window') is not None:
+                self.repeat_window = int(c['repeat_window'])
+            if c.get('extractors') is not None:
+                extractors = c['extractors'].split()
+            options = c
+        self.extractors = ExtractorIndex([
+            EXTRACTORS[name](self, options) for name in extractors
+            if name in EXTRACTORS
+        ])
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.host_slots = {}
+        self.limiter = TokenBucket(
+            1 / self.link_interval if self.link_interval else 0,
+            self.burst or self.links_limit
+        )
+        self.cache = Cache(client.db, 'links', self.cache_size)
+        # Normalized url -> task that downloads it
+        self.inflight = {}
+        # (room, normalized url) -> time when title was posted
+        self.posted = collections.OrderedDict()
+        self.stats = {
+            'downloads': 0,
+            'shared': 0,
+            'repeats': 0,
+        }
+        # Extractor name or 'generic' -> found titles, bytes and seconds
+        self.extractor_stats = collections.defaultdict(
+            lambda: {'titles': 0, 'bytes': 0, 'time': 0.0}
+        )
 
     async def close(self):
-        """Destroy session."""
-        if self.session:
-            logger.info('Destroying links session')
-            await self.session.close()
+        """Log stats on shutdown."""
+        logger.info('Links cache stats: %s', self.cache.stats)
+        logger.info('Links stats: %s', self.stats)
+        for name in self.extractor_stats:
+            if name != 'generic':
+                logger.info('Extractor %s: %s',
+                            name, self.extractor_savings(name))
 
     def is_ignored(self, nick):
         """Check if nickname is ignored."""
@@ -89,80 +360,237 @@ class Links:
 
     @classmethod
     def extract_links(cls, message):
-        """Extract links from message."""
-        return list(set(cls.LINK_RE.findall(message)))
+        """Extract unique links from message in their order."""
+        return list(dict.fromkeys(cls.LINK_RE.findall(message)))
 
     async def process(self, links):
+        """Resolve links concurrently and post titles in message order."""
         if self.disabled:
             return
+        now = time.monotonic()
+        while self.posted:
+            key, posted = next(iter(self.posted.items()))
+            if posted > now - self.repeat_window:
+                break
+            del self.posted[key]
+        fresh = []
+        keys = []
+        for link in links:
+            key = (link['to'], normalize_url(link['link']))
+            if key in self.posted:
+                logger.info('Title was posted recently: %s', link['link'])
+                self.stats['repeats'] += 1
+            else:
+                # Reserve key, so concurrent repeats are skipped too
+                self.posted[key] = now
+                fresh.append(link)
+                keys.append(key)
+        links = fresh
+        tasks = []
         for link in links:
             logger.info('Processing link: %s', link['link'])
-            title = await self.get_title(link['link'])
-            if title is not None:
-                self.client.send_bot_message({
-                    'to': link['to'],
-                    'message': 'TITLE: {}'.format(title)
-                })
-            if len(links) > 1:
-                await asyncio.sleep(self.link_interval)
-        # Just sleep for some time to reduce load
-        await asyncio.sleep(self.link_interval)
+            tasks.append(asyncio.create_task(self.get_title(link['link'])))
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.deadline
+        try:
+            for link, key, task in zip(links, keys, tasks):
+                title = None
+                try:
+                    title = await asyncio.wait_for(
+                        task, max(deadline - loop.time(), 0)
+                    )
+                except asyncio.TimeoutError:
+                    logger.info('Deadline exceeded: %s', link['link'])
+                except Exception:
+                    logger.exception('Error on link %s', link['link'])
+                self.posted.pop(key, None)
+                if title is not None:
+                    self.posted[key] = time.monotonic()
+                    self.client.send_bot_message({
+                        'to': link['to'],
+                        'message': 'TITLE: {}'.format(title),
+                        'priority': PRIORITY_LINK
+                    })
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    @contextlib.asynccontextmanager
+    async def download_slot(self, url):
+        """Limit number and rate of simultaneous downloads."""
+        host = urlsplit(url).hostname
+        slot = self.host_slots.get(host)
+        if slot is None:
+            slot = self.host_slots[host] = [
+                asyncio.Semaphore(self.host_concurrency), 0
+            ]
+        slot[1] += 1
+        try:
+            async with slot[0], self.semaphore:
+                await self.limiter.acquire()
+                yield
+        finally:
+            slot[1] -= 1
+            if not slot[1]:
+                del self.host_slots[host]
 
     def is_allowed(self, url):
         """Check if url isn't blacklisted."""
         parsed_url = urlsplit(url.lower())
         return parsed_url.path.split('.')[-1] not in self.EXT_BLACKLIST
 
-    def get_decoder(self, charset):
-        """Get incremental decoder for specified charset."""
-        cls = codecs.getincrementaldecoder(charset)
-        return cls(errors='ignore')
-
     async def extract_title(self, response):
-        """Extract title from response."""
-        parsed_url = urlsplit(str(response.url).lower())
-        title = None
-        parser = TitleParser(parsed_url)
-        charset = response.charset
-        decoder = None
-        if charset is not None:
-            decoder = self.get_decoder(charset)
-        async for chunk in response.content.iter_chunked(self.CHUNK_SIZE):
-            if not decoder:
-                detected = detect(chunk)
-                if detected['encoding'] is not None:
-                    decoder = self.get_decoder(detected['encoding'])
-            if not decoder:
-                # that page is hopeless
-                logger.info('Can not detect charset')
-                break
-            parser.feed(decoder.decode(chunk))
-            title = parser.get_title()
-            if title is not None:
+        """Extract title from response.
+
+        Reads at most max_bytes and stops at the end of <head>, chunks
+        grow from CHUNK_SIZE to MAX_CHUNK_SIZE. Returns tuple of title
+        and number of bytes read.
+        """
+        scanner = TitleScanner()
+        bytes_read = 0
+        chunk_size = self.CHUNK_SIZE
+        while bytes_read < self.max_bytes and not scanner.done:
+            chunk = await response.content.read(
+                min(chunk_size, self.max_bytes - bytes_read)
+            )
+            if not chunk:
                 break
-        if title is not None:
-            return title.strip()
+            bytes_read += len(chunk)
+            chunk_size = min(chunk_size * 2, self.MAX_CHUNK_SIZE)
+            scanner.feed(chunk)
+        return scanner.get_title(response.charset), bytes_read
 
     async def get_title(self, url):
+        """Get page title, cached results are used when possible."""
         if not self.is_allowed(url):
             logger.debug('Not allowed extension: %s', url)
             return
+        key = normalize_url(url)
+        cached = await self.cache.get(key)
+        if cached is not None:
+            logger.debug('Cached title: %s, %s', url, cached)
+            return cached.get('title')
+        task = self.inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self.download_title(url, key))
+            self.inflight[key] = task
+            task.add_done_callback(
+                lambda t: self.download_done(key, t)
+            )
+        else:
+            logger.debug('Waiting for running download: %s', url)
+            self.stats['shared'] += 1
+        # Download goes on for other waiters if this one is cancelled
+        return await asyncio.shield(task)
+
+    def download_done(self, key, task):
+        """Forget finished download."""
+        del self.inflight[key]
+        if not task.cancelled() and task.exception():
+            logger.error('Download error %s: %r', key, task.exception())
+
+    async def download_title(self, url, key):
+        """Download title and put result to cache."""
+        self.stats['downloads'] += 1
+        title, error = None, None
+        extractor, match = self.extractors.find(url)
+        if extractor:
+            title = await self.run_extractor(extractor, url, match)
+        if not title:
+            async with self.download_slot(url):
+                title, error = await self.fetch_title(url)
+        if title:
+            await self.cache.set(key, {'title': title}, self.cache_ttl)
+        elif error == 'net':
+            await self.cache.set(key, {'error': error}, self.error_ttl)
+        else:
+            await self.cache.set(key, {'error': error}, self.negative_ttl)
+        logger.debug('Links cache stats: %s', self.cache.stats)
+        return title
+
+    async def run_extractor(self, extractor, url, match):
+        """Get title with site extractor, return None on failure."""
+        start = time.monotonic()
+        try:
+            if extractor.network:
+                async with self.download_slot(url):
+                    result = await extractor.get_title(url, match)
+            else:
+                result = await extractor.get_title(url, match)
+        except NET_ERRORS as e:
+            logger.debug('Extractor %s net error: %s %r',
+                         extractor.name, url, e)
+            return None
+        except Exception:
+            logger.exception('Extractor %s error: %s', extractor.name, url)
+            return None
+        if result is None:
+            return None
+        title, bytes_read = result
+        self.update_extractor_stats(extractor.name, bytes_read,
+                                    time.monotonic() - start)
+        logger.info('Found title with %s: %s, %s, %s',
+                    extractor.name, url, title,
+                    self.extractor_savings(extractor.name))
+        return title
+
+    def update_extractor_stats(self, name, bytes_read, elapsed):
+        """Count found title."""
+        stats = self.extractor_stats[name]
+        stats['titles'] += 1
+        stats['bytes'] += bytes_read
+        stats['time'] += elapsed
+
+    def extractor_savings(self, name):
+        """Compare extractor with generic path averages.
+
+        Returns dict with totals for extractor and estimated bytes and
+        seconds saved.
+        """
+        stats = dict(self.extractor_stats[name])
+        stats['time'] = round(stats['time'], 3)
+        generic = self.extractor_stats.get('generic')
+        if generic and generic['titles'] and stats['titles']:
+            stats['bytes_saved'] = int(
+                generic['bytes'] / generic['titles'] * stats['titles'] -
+                stats['bytes']
+            )
+            stats['time_saved'] = round(
+                generic['time'] / generic['titles'] * stats['titles'] -
+                stats['time'], 3
+            )
+        return stats
+
+    async def fetch_title(self, url):
+        """Download page and get its title.
+
+        Returns tuple of title and error reason, one of them is None.
+        """
+        start = time.monotonic()
         try:
-            async with self.session.get(url) as r:
-                # Check mimetype and size
-                if int(
+            headers = {'Range': 'bytes=0-{}'.format(self.max_bytes - 1)}
+            async with self.client.http.get(url, headers=headers) as r:
+                # Check mimetype and size, partial content is limited
+                # by range anyway
+                if r.status != 206 and int(
                         r.headers.get('content-length', self.TOO_LONG)
                 ) > self.TOO_LONG:
                     logger.debug('Content too large: %s', url)
-                    return
+                    return None, 'too_large'
                 mimetype, _ = cgi.parse_header(r.headers.get('content-type', ''))
                 if mimetype not in self.ALLOWED_TYPES:
                     logger.debug('Not allowed: %s, %s', url, mimetype)
-                    return
-                title = await self.extract_title(r)
+                    return None, 'not_html'
+                title, bytes_read = await self.extract_title(r)
                 if title:
-                    logger.info('Found title: %s, %s', url, title)
-                    return title
-        except aiohttp.ClientError as e:
-            logger.debug('Net error: %s', e)
+                    logger.info('Found title: %s, %s, %s bytes read',
+                                url, title, bytes_read)
+                    self.update_extractor_stats('generic', bytes_read,
+                                                time.monotonic() - start)
+                    return title, None
+                logger.debug('%s bytes read from %s', bytes_read, url)
+        except NET_ERRORS as e:
+            logger.debug('Net error: %s %r', url, e)
+            return None, 'net'
         logger.debug('Title not found: %s', url)
+        return None, 'not_found'
@@ -0,0 +1,168 @@
+import time
+import heapq
+import asyncio
+import logging
+from slixmpp.exceptions import IqError, IqTimeout
+
+from billfred.ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Message priorities, lower goes first
+PRIORITY_REPLY = 0
+PRIORITY_LINK = 1
+PRIORITY_FEED = 2
+
+
+def split_message(text, max_length):
+    """Split text into parts not longer than max_length.
+
+    Text is split on line breaks or spaces when possible.
+    """
+    parts = []
+    while len(text) > max_length:
+        cut = text.rfind('\n', 0, max_length + 1)
+        if cut <= 0:
+            cut = text.rfind(' ', 0, max_length + 1)
+        if cut <= 0:
+            cut = max_length
+        parts.append(text[:cut])
+        text = text[cut:].lstrip('\n ')
+    if text:
+        parts.append(text)
+    return parts
+
+
+class Destination:
+    """Queued messages for one recipient."""
+
+    def __init__(self, rate, burst):
+        # (priority, seq, queued time, text)
+        self.heap = []
+        self.limiter = TokenBucket(rate, burst)
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+
+class Outbox:
+    """Rate limited outbound message queue.
+
+    Every destination gets its own queue and token bucket. Messages are
+    sent by priority, small ones waiting in queue are coalesced into one
+    stanza and long ones are split.
+    """
+    RATE = 1
+    BURST = 3
+    MAX_LENGTH = 3000
+    COALESCE_LENGTH = 400
+
+    def __init__(self, client):
+        self.client = client
+        self.rate = self.RATE
+        self.burst = self.BURST
+        self.max_length = self.MAX_LENGTH
+        self.coalesce_length = self.COALESCE_LENGTH
+        conf = client.config
+        if 'outbox' in conf:
+            c = conf['outbox']
+            if c.get('rate') is not None:
+                self.rate = float(c['rate'])
+            if c.get('burst') is not None:
+                self.burst = int(c['burst'])
+            if c.get('max_length') is not None:
+                self.max_length = max(1, int(c['max_length']))
+            if c.get('coalesce_length') is not None:
+                self.coalesce_length = int(c['coalesce_length'])
+        self.destinations = {}
+        self.seq = 0
+        self.stats = {
+            'queued': 0,
+            'stanzas': 0,
+            'coalesced': 0,
+            'split': 0,
+            'dropped': 0,
+            'max_depth': 0,
+            'latency': 0.0,
+            'max_latency': 0.0,
+        }
+
+    @property
+    def depth(self):
+        """Number of messages waiting to be sent."""
+        return sum(len(d.heap) for d in self.destinations.values())
+
+    def send(self, to, message, priority=PRIORITY_REPLY):
+        """Queue message for sending."""
+        dest = self.destinations.get(to)
+        if dest is None:
+            dest = self.destinations[to] = Destination(self.rate, self.burst)
+        parts = split_message(message, self.max_length)
+        if len(parts) > 1:
+            self.stats['split'] += 1
+        now = time.monotonic()
+        for part in parts:
+            self.seq += 1
+            heapq.heappush(dest.heap, (priority, self.seq, now, part))
+            self.stats['queued'] += 1
+        self.stats['max_depth'] = max(self.stats['max_depth'], self.depth)
+        if dest.task is None:
+            dest.task = self.client.create_task(self.run(to, dest))
+        dest.wakeup.set()
+
+    async def run(self, to, dest):
+        """Send queued messages when rate limit allows."""
+        while True:
+            while not dest.heap:
+                dest.wakeup.clear()
+                await dest.wakeup.wait()
+            await dest.limiter.acquire()
+            _, _, queued, text = heapq.heappop(dest.heap)
+            latencies = [queued]
+            parts = [text]
+            length = len(text)
+            # Messages that arrived while waiting go in the same stanza
+            while (dest.heap and length <= self.coalesce_length and
+                   len(dest.heap[0][3]) <= self.coalesce_length and
+                   length + 1 + len(dest.heap[0][3]) <= self.max_length):
+                _, _, queued, text = heapq.heappop(dest.heap)
+                latencies.append(queued)
+                parts.append(text)
+                length += 1 + len(text)
+            self.stats['coalesced'] += len(parts) - 1
+            now = time.monotonic()
+            for queued in latencies:
+                latency = now - queued
+                self.stats['latency'] += latency
+                self.stats['max_latency'] = max(self.stats['max_latency'],
+                                                latency)
+            self.stats['stanzas'] += 1
+            logger.debug('Sending %s messages to %s, waited %.2f s, '
+                         '%s left in queue', len(parts), to,
+                         now - latencies[0], len(dest.heap))
+            self.deliver(to, '\n'.join(parts))
+
+    def deliver(self, to, body):
+        """Send message stanza."""
+        try:
+            self.client.send_message(mto=to, mbody=body, mtype='groupchat')
+        except IqError as e:
+            logger.info("Error sending message to %s: %s",
+                        to, e.iq['error']['condition'])
+        except IqTimeout:
+            logger.info("No response from %s", to)
+        except Exception:
+            logger.exception("Error on message send")
+
+    async def close(self):
+        """Stop sending, drop queued messages and log stats."""
+        tasks = []
+        for dest in self.destinations.values():
+            self.stats['dropped'] += len(dest.heap)
+            if dest.task is not None:
+                dest.task.cancel()
+                tasks.append(dest.task)
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.destinations = {}
+        sent = self.stats['queued'] - self.stats['dropped']
+        logger.info('Outbox stats: %s, average latency %.2f s',
+                    self.stats, self.stats['latency'] / (sent or 1))
@@ -0,0 +1,45 @@
+import time
+import asyncio
+
+
+class TokenBucket:
+    """Token bucket rate limiter.
+
+    Bucket holds up to burst tokens and gets rate tokens per second.
+    Zero rate means no limit.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def refill(self):
+        """Add tokens for time passed since last refill."""
+        now = time.monotonic()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, tokens=1):
+        """Take tokens if available, return True on success."""
+        if not self.rate:
+            return True
+        self.refill()
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+
+    def delay(self, tokens=1):
+        """Seconds until tokens will be available."""
+        if not self.rate:
+            return 0
+        self.refill()
+        return max(0, (tokens - self.tokens) / self.rate)
+
+    async def acquire(self, tokens=1):
+        """Wait until tokens are available and take them."""
+        while not self.try_acquire(tokens):
+            await asyncio.sleep(self.delay(tokens))
@@ -0,0 +1,231 @@
+import asyncio
+import logging
+import collections
+
+from billfred.ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Overload policies: drop new work, drop oldest queued work or keep new
+# work in overflow queue until there is room
+DROP_NEW = 'drop_new'
+DROP_OLDEST = 'drop_oldest'
+DEFER = 'defer'
+POLICIES = (DROP_NEW, DROP_OLDEST, DEFER)
+
+
+class WorkQueue:
+    """Bounded queue of one kind of work with its workers.
+
+    Deferred jobs wait in overflow queue, it holds at most overflow_size
+    jobs, newer ones are dropped. Lossless queue keeps deferring jobs
+    past overflow_size and only logs a warning.
+    """
+
+    def __init__(self, name, workers, size, policy, overflow_size,
+                 lossless=False):
+        self.name = name
+        self.workers = workers
+        self.policy = policy
+        self.queue = asyncio.Queue(maxsize=size)
+        self.overflow = collections.deque()
+        self.overflow_size = overflow_size
+        self.lossless = lossless
+        # Set while overflow queue is over overflow_size
+        self.overflowed = False
+        self.tasks = []
+        self.stats = {
+            'submitted': 0,
+            'done': 0,
+            'errors': 0,
+            'dropped': 0,
+            'shed': 0,
+            'deferred': 0,
+            'limited': 0,
+        }
+
+    @property
+    def depth(self):
+        """Number of waiting jobs, deferred ones included."""
+        return self.queue.qsize() + len(self.overflow)
+
+    def put(self, job):
+        """Queue job according to overload policy, False if dropped."""
+        if self.policy == DEFER and (self.overflow or self.queue.full()):
+            # Keep order while overflow is drained
+            return self.defer(job)
+        if self.queue.full():
+            if self.policy == DROP_NEW:
+                self.stats['dropped'] += 1
+                return False
+            self.queue.get_nowait()
+            self.queue.task_done()
+            self.stats['shed'] += 1
+        self.queue.put_nowait(job)
+        return True
+
+    def defer(self, job):
+        """Put job to overflow queue, False if it's full."""
+        full = len(self.overflow) >= self.overflow_size
+        if full and not self.lossless:
+            self.stats['dropped'] += 1
+            if not self.overflowed:
+                self.overflowed = True
+                logger.error('Overflow of %s queue is full with %s jobs, '
+                             'new jobs are dropped', self.name,
+                             len(self.overflow))
+            return False
+        if full and not self.overflowed:
+            self.overflowed = True
+            logger.warning('Overflow of %s queue has %s jobs, they are '
+                           'kept in memory', self.name, len(self.overflow))
+        self.overflow.append(job)
+        self.stats['deferred'] += 1
+        return True
+
+    async def work(self):
+        """Run queued jobs one by one."""
+        while True:
+            func, args = await self.queue.get()
+            try:
+                await func(*args)
+                self.stats['done'] += 1
+            except Exception:
+                self.stats['errors'] += 1
+                logger.exception('Error in %s job', self.name)
+            finally:
+                self.queue.task_done()
+                while self.overflow and not self.queue.full():
+                    self.queue.put_nowait(self.overflow.popleft())
+                if self.overflowed and not self.overflow:
+                    self.overflowed = False
+                    logger.warning('Overflow of %s queue is drained, '
+                                   '%s jobs dropped in total', self.name,
+                                   self.stats['dropped'])
+
+    async def drain(self):
+        """Wait until all queued, running and deferred jobs are done."""
+        # Running jobs aren't in depth, but join waits for them too
+        await self.queue.join()
+        while self.depth:
+            await self.queue.join()
+
+
+class Scheduler:
+    """Run bot work in bounded queues with fixed number of workers.
+
+    Every kind of work has its own queue, workers and overload policy.
+    Work from one nick is rate limited with token bucket. Jobs are
+    callables that return coroutines, so dropped work costs nothing.
+    """
+    KINDS = {
+        'log': (1, 1000, DEFER),
+        # Newer links are more interesting than old ones
+        'links': (2, 50, DROP_OLDEST),
+        'command': (4, 50, DROP_NEW),
+    }
+    # Chat log writes are never dropped, they are always deferred
+    LOSSLESS = ('log',)
+    # Max number of deferred jobs of every kind
+    OVERFLOW_SIZE = 20000
+    NICK_RATE = 0.5
+    NICK_BURST = 5
+    MAX_NICKS = 1000
+
+    def __init__(self, client):
+        self.client = client
+        self.nick_rate = self.NICK_RATE
+        self.nick_burst = self.NICK_BURST
+        conf = client.config
+        c = conf['scheduler'] if 'scheduler' in conf else {}
+        if c.get('nick_rate') is not None:
+            self.nick_rate = float(c['nick_rate'])
+        if c.get('nick_burst') is not None:
+            self.nick_burst = int(c['nick_burst'])
+        self.queues = {}
+        for name, (workers, size, policy) in self.KINDS.items():
+            if c.get('{}_workers'.format(name)) is not None:
+                workers = max(1, int(c['{}_workers'.format(name)]))
+            if c.get('{}_queue'.format(name)) is not None:
+                size = max(1, int(c['{}_queue'.format(name)]))
+            if c.get('{}_policy'.format(name)) in POLICIES:
+                policy = c['{}_policy'.format(name)]
+            if name in self.LOSSLESS and policy != DEFER:
+                logger.warning('Jobs of %s queue are never dropped, '
+                               'policy %s ignored', name, policy)
+                policy = DEFER
+            overflow_size = self.OVERFLOW_SIZE
+            if c.get('{}_overflow'.format(name)) is not None:
+                overflow_size = max(0, int(c['{}_overflow'.format(name)]))
+            self.queues[name] = WorkQueue(name, workers, size, policy,
+                                          overflow_size,
+                                          name in self.LOSSLESS)
+        # Nick -> token bucket, least recently active are forgotten
+        self.nicks = collections.OrderedDict()
+
+    def start(self):
+        """Start workers."""
+        for queue in self.queues.values():
+            queue.tasks = [asyncio.create_task(queue.work())
+                           for _ in range(queue.workers)]
+
+    def allow(self, nick):
+        """Check rate limit of nick."""
+        bucket = self.nicks.get(nick)
+        if bucket is None:
+            bucket = self.nicks[nick] = TokenBucket(self.nick_rate,
+                                                    self.nick_burst)
+            if len(self.nicks) > self.MAX_NICKS:
+                self.nicks.popitem(last=False)
+        self.nicks.move_to_end(nick)
+        return bucket.try_acquire()
+
+    def submit(self, kind, func, *args, nick=None):
+        """Queue func(*args) coroutine call, False if it was dropped.
+
+        Work with nick is rate limited for that nick.
+        """
+        queue = self.queues[kind]
+        queue.stats['submitted'] += 1
+        if nick is not None and not self.allow(nick):
+            queue.stats['limited'] += 1
+            logger.debug('Rate limited %s job from %s', kind, nick)
+            return False
+        if not queue.put((func, args)):
+            logger.debug('Queue %s is full, job dropped', kind)
+            return False
+        return True
+
+    def depths(self):
+        """Get number of waiting jobs of every kind."""
+        return {name: queue.depth for name, queue in self.queues.items()}
+
+    def report(self):
+        """Get short text with queue depths and drop counts."""
+        return '; '.join(
+            '{}: {} queued, {} done, {} dropped, {} shed, {} limited, '
+            '{} deferred'.format(
+                name, queue.depth, queue.stats['done'],
+                queue.stats['dropped'], queue.stats['shed'],
+                queue.stats['limited'], queue.stats['deferred'])
+            for name, queue in self.queues.items()
+        )
+
+    async def close(self):
+        """Finish deferred work, drop the rest and stop workers."""
+        tasks = []
+        for queue in self.queues.values():
+            if queue.policy == DEFER:
+                if queue.tasks:
+                    await queue.drain()
+            else:
+                while not queue.queue.empty():
+                    queue.queue.get_nowait()
+                    queue.queue.task_done()
+                    queue.stats['shed'] += 1
+            tasks.extend(queue.tasks)
+            queue.tasks = []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        logger.info('Scheduler stats: %s', self.report())
@@ -1,47 +1,97 @@
+import os
+import re
 import asyncio
 import logging
-import aiohttp
 from urllib.parse import urlencode, quote
 
+from billfred.cache import Cache
+from billfred.httpclient import NET_ERRORS
+from billfred.wikiindex import TitleIndex
+
 
 logger = logging.getLogger(__name__)
 
 
 class Wiki:
     """Search wikipedia for articles."""
-    BASE_URL = 'https://{lang}.wikipedia.org{query}'
-    API_INTERVAL = 2
+    BASE_URL = 'https://{lang}.wikipedia.org'
     DEFAULT_LANG = 'ru'
     ARTICLES_LIMIT = 3
+    EXTRACT_SENTENCES = 2
+    EXTRACT_LENGTH = 300
+    LANG_CONCURRENCY = 2
+    LANG_RE = re.compile(r'^[a-z][a-z-]*$')
+    CACHE_SIZE = 1000
+    CACHE_TTL = 60 * 60 * 6
+    CACHE_STALE = 60 * 60 * 24 * 7
 
     def __init__(self, client):
         self.client = client
-        self.session = aiohttp.ClientSession()
-
-    async def close(self):
-        """Destroy session."""
-        if self.session:
-            logger.info('Destroying links session')
-            await self.session.close()
+        self.cache_size = self.CACHE_SIZE
+        self.cache_ttl = self.CACHE_TTL
+        self.cache_stale = self.CACHE_STALE
+        self.base_url = self.BASE_URL
+        self.lang_concurrency = self.LANG_CONCURRENCY
+        self.index_dir = None
+        conf = client.config
+        if 'wiki' in conf:
+            c = conf['wiki']
+            if c.get('cache_size') is not None:
+                self.cache_size = int(c['cache_size'])
+            if c.get('cache_ttl') is not None:
+                self.cache_ttl = int(c['cache_ttl'])
+            if c.get('cache_stale') is not None:
+                self.cache_stale = int(c['cache_stale'])
+            if c.get('base_url'):
+                self.base_url = c['base_url'].rstrip('/')
+            if c.get('lang_concurrency') is not None:
+                self.lang_concurrency = max(1, int(c['lang_concurrency']))
+            if c.get('index_dir'):
+                self.index_dir = c['index_dir']
+        # Results with extracts are kept apart from old snippet results
+        self.cache = Cache(client.db, 'wiki_extracts', self.cache_size,
+                           self.cache_stale)
+        # Cache key -> task that requests it
+        self.inflight = {}
+        # Language -> semaphore for its API requests
+        self.lang_slots = {}
+        # Language -> (index file mtime, TitleIndex or None)
+        self.indexes = {}
+        self.index_stats = {
+            'hits': 0,
+            'misses': 0,
+        }
 
     def api_url(self, query, lang):
         """Get API url for specified language"""
         q = '/w/api.php?{}'.format(urlencode(query))
-        return self.BASE_URL.format(lang=lang, query=q)
+        return self.base_url.format(lang=lang) + q
 
     def page_url(self, page, lang):
         """Get API url for specified language"""
         q = '/wiki/{}'.format(quote(page))
-        return self.BASE_URL.format(lang=lang, query=q)
-
-    def format_snippet(self, text):
-        """Transform tags from snippet to something that can be displayed."""
-        if text:
-            text = text.\
-                replace('<span class="searchmatch">', '_').\
-                replace('</span>', '_')
+        return self.base_url.format(lang=lang) + q
+
+    def format_extract(self, text):
+        """Shorten article extract to one line."""
+        text = ' '.join((text or '').split())
+        if len(text) > self.EXTRACT_LENGTH:
+            text = text[:self.EXTRACT_LENGTH].rsplit(' ', 1)[0] + '...'
         return text
 
+    def lang_slot(self, lang):
+        """Get semaphore that limits requests to one language wiki.
+
+        It's the only limit of API requests, wikis of other languages
+        are queried at the same time.
+        """
+        slot = self.lang_slots.get(lang)
+        if slot is None:
+            slot = self.lang_slots[lang] = asyncio.Semaphore(
+                self.lang_concurrency
+            )
+        return slot
+
     def parse_command(self, message):
         """Parse wiki command arguments."""
         tokens = message.split()
@@ -56,51 +106,149 @@ class Wiki:
         query = ' '.join(tokens[2:])
         return query, lang, in_title
 
+    def cache_key(self, text, lang, only_title):
+        """Get cache key for normalized query."""
+        query = ' '.join(text.casefold().split())
+        return '{}:{}:{}'.format(lang, int(bool(only_title)), query)
+
+    def title_index(self, lang):
+        """Get title index for language or None.
+
+        Index is reopened when its file is rebuilt.
+        """
+        if not self.index_dir or not self.LANG_RE.match(lang):
+            return None
+        path = os.path.join(self.index_dir, '{}.idx'.format(lang))
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            mtime = None
+        cached = self.indexes.get(lang)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        if cached is not None and cached[1] is not None:
+            cached[1].close()
+        index = None
+        if mtime is not None:
+            try:
+                index = TitleIndex(path)
+                logger.info('Opened %s title index with %s titles',
+                            lang, len(index))
+            except (OSError, ValueError):
+                logger.exception('Can not open title index %s', path)
+        self.indexes[lang] = (mtime, index)
+        return index
+
+    def index_search(self, text, lang):
+        """Find titles in local index, returns formatted results."""
+        index = self.title_index(lang)
+        if index is None:
+            return []
+        titles = index.lookup(text, self.ARTICLES_LIMIT)
+        self.index_stats['hits' if titles else 'misses'] += 1
+        return ['{} - *{}*'.format(self.page_url(title, lang), title)
+                for title in titles]
+
     async def search(self, text, lang, only_title=True):
         """Ask Wikipedia about something. Don't ask about bad things!"""
         logger.info('Searching wiki %s %s %s', text, lang, only_title)
+        if only_title:
+            result = self.index_search(text, lang)
+            if result:
+                self.client.send_bot_message({
+                    'message': '\n\n'.join(result)
+                })
+                return
+        key = self.cache_key(text, lang, only_title)
+        result, fresh = await self.cache.lookup(key)
+        if result is None:
+            result = await self.query(key, text, lang, only_title)
+        elif not fresh and key not in self.inflight:
+            # Answer with stale result and refresh it in background
+            logger.debug('Refreshing stale wiki result %s', key)
+            self.query(key, text, lang, only_title)
+        logger.debug('Wiki cache hit rate %.0f%%: %s',
+                     self.cache.hit_rate * 100, self.cache.stats)
+
+        if result is None:
+            result = ['Search error']
+        if not result:
+            result = ['Nothing found, sorry']
+
+        self.client.send_bot_message({
+            'message': '\n\n'.join(result)
+        })
+
+    def query(self, key, text, lang, only_title):
+        """Get future with search results, one request runs for a key."""
+        task = self.inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(
+                self.fetch(key, text, lang, only_title)
+            )
+            self.inflight[key] = task
+            task.add_done_callback(lambda t: self.inflight.pop(key, None))
+        # Request goes on for other waiters if this one is cancelled
+        return asyncio.shield(task)
+
+    async def fetch(self, key, text, lang, only_title):
+        """Request search results and cache them.
+
+        Found pages with their URLs and intro extracts come in one
+        response. Returns list of formatted results or None on error,
+        errors are not cached.
+        """
         q = {
             'action': 'query',
-            'list': 'search',
             'format': 'json',
-            'srsearch': 'intitle:{}'.format(text) if only_title else text,
-            'srnamespace': 0,
-            'srprop': 'snippet',
-            'srlimit': self.ARTICLES_LIMIT,
+            'formatversion': 2,
+            'generator': 'search',
+            'gsrsearch': 'intitle:{}'.format(text) if only_title else text,
+            'gsrnamespace': 0,
+            'gsrlimit': self.ARTICLES_LIMIT,
+            'prop': 'extracts|info',
+            'exintro': 1,
+            'explaintext': 1,
+            'exsentences': self.EXTRACT_SENTENCES,
+            'exlimit': self.ARTICLES_LIMIT,
+            'inprop': 'url',
         }
         url = self.api_url(q, lang)
-        error = False
         result = []
         try:
-            logger.info('Querying %s', url)
-            async with self.session.get(url) as r:
-                response = await r.json()
-            if not response.get('query', {}).get('search'):
+            async with self.lang_slot(lang):
+                logger.info('Querying %s', url)
+                async with self.client.http.get(url) as r:
+                    response = await r.json()
+            if not isinstance(response, dict) or 'error' in response:
                 logger.warning("Response doesn't contain results: %s",
                                response)
-                error = True
-            else:
-                for item in response['query']['search']:
-                    link = self.page_url(item['title'], lang)
-                    snippet = self.format_snippet(item.get('snippet'))
-                    text = '{} - *{}*: {}'.format(link,
-                                                  item.get('title'),
-                                                  snippet)
-                    result.append(text)
-        except aiohttp.ClientError as e:
-            logger.error('Net error: %s', e)
-            error = True
+                return None
+            # No query key means nothing was found
+            pages = response.get('query', {}).get('pages', [])
+            for item in sorted(pages, key=lambda p: p.get('index', 0)):
+                link = item.get('fullurl') or self.page_url(item['title'],
+                                                            lang)
+                extract = self.format_extract(item.get('extract'))
+                text = '{} - *{}*: {}'.format(link,
+                                              item.get('title'),
+                                              extract)
+                result.append(text)
+        except NET_ERRORS as e:
+            logger.error('Net error: %r', e)
+            return None
         except Exception as e:
             logger.exception("Unhandled exception: %s", e)
-            error = True
-
-        if error:
-            result = ['Search error']
-        if not result:
-            result = ['Nothing found, sorry']
-
-        self.client.send_bot_message({
-            'message': '\n\n'.join(result)
-        })
+            return None
+        await self.cache.set(key, result, self.cache_ttl)
+        return result
 
-        await asyncio.sleep(self.API_INTERVAL)
+    async def close(self):
+        """Log stats and close title indexes on shutdown."""
+        logger.info('Wiki cache hit rate %.0f%%: %s',
+                    self.cache.hit_rate * 100, self.cache.stats)
+        logger.info('Wiki title index stats: %s', self.index_stats)
+        for _, index in self.indexes.values():
+            if index is not None:
+                index.close()
+        self.indexes = {}
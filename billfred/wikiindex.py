@@ -0,0 +1,228 @@
+import os
+import sys
+import gzip
+import mmap
+import time
+import heapq
+import struct
+import argparse
+import tempfile
+import configparser
+from array import array
+
+# Index file: header, array of record offsets, sorted records.
+# Every record is casefolded key, tab, title and newline in UTF-8.
+MAGIC = b'BFWIDX1' + (b'L' if sys.byteorder == 'little' else b'B')
+HEADER = struct.Struct('=8sQ')
+CHUNK_SIZE = 500000
+DUMP_HEADER = b'page_title'
+
+
+def normalize_title(title):
+    """Get lookup key for title or query."""
+    return ' '.join(title.replace('_', ' ').split()).casefold()
+
+
+def read_titles(path):
+    """Yield titles from all-titles-in-ns0 dump, gzipped or plain."""
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as f:
+        for line in f:
+            title = line.rstrip(b'\r\n').decode('utf-8', 'replace')
+            if title and title.encode() != DUMP_HEADER:
+                yield title.replace('_', ' ')
+
+
+def write_run(lines, tmp_dir):
+    """Sort lines and write them to temporary file."""
+    lines.sort()
+    f = tempfile.TemporaryFile(dir=tmp_dir)
+    f.writelines(lines)
+    f.seek(0)
+    return f
+
+
+def build_index(titles, output, chunk_size=CHUNK_SIZE, tmp_dir=None):
+    """Build index file from titles with external sort.
+
+    Only chunk_size titles are sorted in memory at once, sorted runs
+    are merged from temporary files. Returns number of records.
+    """
+    runs = []
+    lines = []
+    for title in titles:
+        key = normalize_title(title)
+        if not key:
+            continue
+        lines.append('{}\t{}\n'.format(key, title).encode())
+        if len(lines) >= chunk_size:
+            runs.append(write_run(lines, tmp_dir))
+            lines = []
+    if lines:
+        runs.append(write_run(lines, tmp_dir))
+    del lines
+
+    count = 0
+    position = 0
+    offsets = array('Q')
+    with tempfile.TemporaryFile(dir=tmp_dir) as data, \
+            tempfile.TemporaryFile(dir=tmp_dir) as offsets_file:
+        previous = None
+        for line in heapq.merge(*runs):
+            if line == previous:
+                continue
+            previous = line
+            offsets.append(position)
+            data.write(line)
+            position += len(line)
+            count += 1
+            if len(offsets) >= chunk_size:
+                offsets.tofile(offsets_file)
+                del offsets[:]
+        offsets.tofile(offsets_file)
+        for run in runs:
+            run.close()
+        # Write to new file, so index can be replaced while it's used
+        partial = output + '.tmp'
+        with open(partial, 'wb') as out:
+            out.write(HEADER.pack(MAGIC, count))
+            for part in (offsets_file, data):
+                part.seek(0)
+                while True:
+                    block = part.read(1 << 20)
+                    if not block:
+                        break
+                    out.write(block)
+        os.replace(partial, output)
+    return count
+
+
+class TitleIndex:
+    """Read-only title index in memory mapped file.
+
+    Records are found by binary search over the offsets array, titles
+    are decoded only for returned results.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        try:
+            self.mm = mmap.mmap(self.file.fileno(), 0,
+                                access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty file can't be mapped
+            self.file.close()
+            raise ValueError('Bad title index file {}'.format(path))
+        magic, count = None, 0
+        if len(self.mm) >= HEADER.size:
+            magic, count = HEADER.unpack_from(self.mm, 0)
+        end = HEADER.size + count * 8
+        if magic != MAGIC or len(self.mm) < end:
+            self.close()
+            raise ValueError('Bad title index file {}'.format(path))
+        self.count = count
+        self.offsets = memoryview(self.mm)[HEADER.size:end].cast('Q')
+        self.data_start = end
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        """Get key of record i, used for binary search."""
+        start = self.data_start + self.offsets[i]
+        return self.mm[start:self.mm.find(b'\t', start)]
+
+    def record(self, i):
+        """Get key and title of record i."""
+        start = self.data_start + self.offsets[i]
+        line = self.mm[start:self.mm.find(b'\n', start)]
+        key, title = line.split(b'\t', 1)
+        return key, title.decode()
+
+    def lookup(self, query, limit):
+        """Find titles equal to query or starting with it, ignoring case.
+
+        Exact matches go first, then prefix matches in key order.
+        """
+        key = normalize_title(query).encode()
+        result = []
+        if not key:
+            return result
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self[mid] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        for i in range(lo, self.count):
+            record_key, title = self.record(i)
+            if not record_key.startswith(key) or len(result) >= limit:
+                break
+            result.append(title)
+        return result
+
+    def close(self):
+        """Unmap index file."""
+        if getattr(self, 'offsets', None) is not None:
+            self.offsets.release()
+            self.offsets = None
+        self.mm.close()
+        self.file.close()
+
+
+def main():
+    """Build title index from Wikipedia dump."""
+    parser = argparse.ArgumentParser(
+        description='Build title index from all-titles-in-ns0 dump.'
+    )
+    parser.add_argument(
+        'dump',
+        help='path to dump file, gzipped or plain'
+    )
+    parser.add_argument(
+        '--config',
+        default='billfred.cfg',
+        help='path to config file with [wiki] index_dir'
+    )
+    parser.add_argument(
+        '--lang',
+        help='wiki language, index is written to index_dir/LANG.idx'
+    )
+    parser.add_argument(
+        '--output',
+        help='path to index file, overrides config'
+    )
+    parser.add_argument(
+        '--chunk-size',
+        type=int,
+        default=CHUNK_SIZE,
+        help='titles sorted in memory at once'
+    )
+    parser.add_argument(
+        '--tmp-dir',
+        help='directory for temporary files'
+    )
+    args = parser.parse_args()
+
+    output = args.output
+    if not output:
+        config = configparser.ConfigParser()
+        config.read(args.config)
+        index_dir = config.get('wiki', 'index_dir', fallback=None)
+        if not index_dir or not args.lang:
+            sys.exit('Specify --output or --lang and [wiki] index_dir')
+        output = os.path.join(index_dir, '{}.idx'.format(args.lang))
+
+    start = time.perf_counter()
+    count = build_index(read_titles(args.dump), output,
+                        max(1, args.chunk_size), args.tmp_dir)
+    elapsed = time.perf_counter() - start
+    print('Indexed {} titles to {} in {:.2f} s'.format(
+        count, output, elapsed
+    ), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
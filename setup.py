@@ -28,11 +28,17 @@ setup(
         'aiohttp',
         'charset-normalizer',
     ],
+    extras_require={
+        # Accept brotli compressed feeds and pages
+        'brotli': ['Brotli'],
+    },
 
     include_package_data=True,
     entry_points={
         'console_scripts': [
             'billfred=billfred:main',
+            'billfred-export=billfred.export:main',
+            'billfred-wikiindex=billfred.wikiindex:main',
         ],
     },
 )
@@ -0,0 +1,45 @@
+import asyncio
+import contextlib
+import configparser
+
+from aiohttp import web
+
+from billfred.database import Database
+from billfred.httpclient import HttpClient
+
+
+class Client:
+    """Bot stand-in with config, database and HTTP client."""
+
+    def __init__(self, path, config):
+        self.config = configparser.ConfigParser()
+        self.config.read_dict(config)
+        self.user_agent = 'billfred-test'
+        self.db = Database(str(path))
+        self.http = HttpClient(self)
+        self.sent = []
+
+    def send_bot_message(self, message):
+        self.sent.append(message)
+
+    def create_task(self, coro):
+        return asyncio.ensure_future(coro)
+
+    async def close(self):
+        await self.http.close()
+        await self.db.close()
+
+
+@contextlib.asynccontextmanager
+async def stub_server(routes):
+    """Run local HTTP server with GET routes, yield its base URL."""
+    app = web.Application()
+    for path, handler in routes.items():
+        app.router.add_get(path, handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', 0).start()
+    try:
+        yield 'http://127.0.0.1:{}'.format(runner.addresses[0][1])
+    finally:
+        await runner.cleanup()
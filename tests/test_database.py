@@ -0,0 +1,64 @@
+import asyncio
+import sqlite3
+
+from billfred.database import Database
+
+
+def create_old_db(path, rows):
+    """Create 0.2 database without chat log indexes."""
+    conn = sqlite3.connect(path)
+    conn.execute(r'''
+    CREATE TABLE chat_log (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      time INTEGER NOT NULL,
+      jid TEXT NOT NULL,
+      nick TEXT NOT NULL,
+      message TEXT
+    )''')
+    conn.execute(r'''
+    CREATE TABLE version (
+      id INTEGER PRIMARY KEY,
+      time INTEGER NOT NULL,
+      version TEXT NOT NULL
+    )''')
+    conn.execute(r"INSERT INTO version VALUES (1, 0, '0.2')")
+    conn.executemany(
+        r'INSERT INTO chat_log (time, jid, nick, message) '
+        'VALUES (?, ?, ?, ?)', rows
+    )
+    conn.commit()
+    conn.close()
+
+
+def test_iter_log_filters_on_migrated_db(tmp_path):
+    path = str(tmp_path / 'old.db')
+    # Times go back now and then, ids are still the export order
+    rows = [(i - 7 * (i % 10 == 0), 'room@conference',
+             'nick{}'.format(i % 3), 'message {}'.format(i))
+            for i in range(1, 200)]
+    create_old_db(path, rows)
+    expected = [(i,) + row for i, row in enumerate(rows, 1)]
+
+    async def export(db, **kwargs):
+        return [row async for row in db.iter_log(**kwargs)]
+
+    async def main():
+        db = Database(path)
+        db.READ_PAGE_SIZE = 7
+        await db.init()
+        try:
+            return (await export(db),
+                    await export(db, nick='nick1'),
+                    await export(db, nick='nick2', since=50, until=150),
+                    await export(db, since=50, until=150),
+                    await export(db, nick='nobody'))
+        finally:
+            await db.close()
+
+    every, nick, nick_time, by_time, nobody = asyncio.run(main())
+    assert every == expected
+    assert nick == [r for r in expected if r[3] == 'nick1']
+    assert nick_time == [r for r in expected
+                         if r[3] == 'nick2' and 50 <= r[1] < 150]
+    assert by_time == [r for r in expected if 50 <= r[1] < 150]
+    assert nobody == []
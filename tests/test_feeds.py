@@ -0,0 +1,113 @@
+import asyncio
+
+from aiohttp import web
+
+from billfred.feeds import fetch_feed, process_feed
+from helpers import Client, stub_server
+
+HEADERS = {'content-type': 'application/rss+xml'}
+DATES = {
+    'a': 'Mon, 01 Jan 2024 00:00:00 GMT',
+    'b': 'Tue, 02 Jan 2024 00:00:00 GMT',
+    'c': 'Wed, 03 Jan 2024 00:00:00 GMT',
+}
+
+
+def rss(*names):
+    items = ''.join(
+        '<item><title>{0}</title><link>http://example.com/{0}</link>'
+        '<guid>http://example.com/{0}</guid><pubDate>{1}</pubDate>'
+        '</item>'.format(name, DATES[name])
+        for name in names
+    )
+    return ('<?xml version="1.0"?><rss version="2.0"><channel>'
+            '<title>t</title>{}</channel></rss>'.format(items)).encode()
+
+
+def state(ordered, *names):
+    return {
+        'last_date': None,
+        'etag': None,
+        'modified': None,
+        'ordered': ordered,
+        'seen': {n if ':' in n else 'http://example.com/{}'.format(n)
+                 for n in names},
+    }
+
+
+def test_oldest_first_feed_announces_appended_entry():
+    entries, new_state, new_ids = process_feed(
+        'P', rss('a', 'b', 'c'), HEADERS, False, state(False, 'a', 'b')
+    )
+    assert entries == ['P: c http://example.com/c']
+    assert new_ids == ['http://example.com/c']
+    assert not new_state['ordered']
+
+
+def test_newest_first_feed_stops_at_seen_entry():
+    entries, new_state, new_ids = process_feed(
+        'P', rss('c', 'b', 'a'), HEADERS, False, state(True, 'b')
+    )
+    assert entries == ['P: c http://example.com/c']
+    assert new_state['ordered']
+
+
+def test_new_ids_go_from_oldest_to_newest():
+    _, _, new_ids = process_feed('P', rss('b', 'c', 'a'), HEADERS)
+    assert new_ids == ['http://example.com/{}'.format(n) for n in 'abc']
+
+
+def test_broken_first_poll_is_not_saved():
+    entries, new_state, new_ids = process_feed(
+        'P', b'<rss><channel><item>', HEADERS
+    )
+    assert (entries, new_state, new_ids) == ([], None, [])
+
+
+def atom(count):
+    entries = ''.join(
+        '<entry><id>urn:entry:{0}</id><title>Entry {0}</title>'
+        '<link href="http://example.com/{0}"/>'
+        '<updated>2024-01-01T00:{1:02}:{2:02}Z</updated>'
+        '<content type="html">{3}</content></entry>'.format(
+            i, (count - i) // 60 % 60, (count - i) % 60, 'text ' * 200)
+        for i in range(count)
+    )
+    return ('<?xml version="1.0" encoding="utf-8"?>'
+            '<feed xmlns="http://www.w3.org/2005/Atom"><title>t</title>'
+            '<id>urn:feed</id>{}</feed>'.format(entries)).encode()
+
+
+def fetch(tmp_path, data, seen):
+    async def feed(request):
+        return web.Response(body=data, content_type='application/atom+xml')
+
+    async def main():
+        async with stub_server({'/feed': feed}) as base:
+            client = Client(tmp_path / 'test.db', {})
+            try:
+                return await fetch_feed(client, base + '/feed',
+                                        state(True, *seen))
+            finally:
+                await client.http.close()
+    return asyncio.run(main())
+
+
+def test_ordered_feed_download_stops_at_seen_entry(tmp_path):
+    data = atom(2000)
+    status, body, _, size, entries = fetch(
+        tmp_path, data, ['urn:entry:3', 'urn:entry:4']
+    )
+    assert status == 200
+    assert body is None
+    assert [e['id'] for e in entries] == ['urn:entry:{}'.format(i)
+                                          for i in range(3)]
+    assert size < len(data) / 10
+
+
+def test_feed_is_read_whole_when_stream_fails(tmp_path):
+    data = atom(100)
+    _, body, _, size, entries = fetch(tmp_path, data, ['urn:unknown'])
+    assert entries is None
+    assert body == data
+    assert size == len(data)
@@ -0,0 +1,96 @@
+import asyncio
+
+from aiohttp import web
+
+from billfred.links import Links, TitleScanner
+from helpers import Client, stub_server
+
+
+def test_extract_links_keeps_message_order():
+    message = 'see http://c.com/ http://a.com/ http://b.com/ http://a.com/'
+    assert Links.extract_links(message) == [
+        'http://c.com/', 'http://a.com/', 'http://b.com/'
+    ]
+
+
+def scan_title(page, size):
+    scanner = TitleScanner()
+    for i in range(0, len(page), size):
+        scanner.feed(page[i:i + size])
+    return scanner.get_title()
+
+
+def test_title_scanner_skips_scripts_styles_and_comments():
+    pages = [
+        (b'<script>var a="<body>";</script><title>X</title>', 'X'),
+        (b'<script>"<title>fake</title>"</script><title>Real</title>',
+         'Real'),
+        (b'<!-- <title>old</title> --><title>new</title>', 'new'),
+        (b'<STYLE>a:after{content:"</head>"}</Style ><title>S</title>',
+         'S'),
+        (b'<script type="module">1</script><script>2</script>'
+         b'<!----><title>Two</title>', 'Two'),
+    ]
+    for page, title in pages:
+        for size in (1, 2, 3, 7, len(page)):
+            assert scan_title(page, size) == title, (page, size)
+
+
+def test_oembed_extractors_use_configured_endpoints(tmp_path):
+    requests = []
+
+    async def oembed(request):
+        requests.append(request.query['url'])
+        if 'missing' in request.query['url']:
+            raise web.HTTPNotFound()
+        return web.json_response({'title': 'Video'})
+
+    async def main():
+        async with stub_server({'/oembed': oembed}) as base:
+            client = Client(tmp_path / 'test.db', {'links': {
+                'interval': '0',
+                'youtube_endpoint': base + '/oembed',
+                'vimeo_endpoint': base + '/oembed',
+            }})
+            await client.db.init()
+            try:
+                links = Links(client)
+                youtube = await links.get_title(
+                    'https://www.youtube.com/watch?v=abc'
+                )
+                vimeo = await links.get_title('https://vimeo.com/123')
+                extractor, match = links.extractors.find(
+                    'https://youtu.be/missing1234'
+                )
+                missing = await extractor.get_title(
+                    'https://youtu.be/missing1234', match
+                )
+            finally:
+                await client.close()
+        return youtube, vimeo, missing, links.extractor_stats
+
+    youtube, vimeo, missing, stats = asyncio.run(main())
+    assert youtube == 'Video - YouTube'
+    assert vimeo == 'Video - Vimeo'
+    assert missing is None
+    assert requests == ['https://www.youtube.com/watch?v=abc',
+                        'https://vimeo.com/123',
+                        'https://youtu.be/missing1234']
+    assert stats['youtube']['titles'] == 1
+    assert stats['youtube']['bytes'] > 0
+
+
+def test_wikipedia_extractor_builds_title_from_url(tmp_path):
+    async def main():
+        client = Client(tmp_path / 'test.db', {})
+        await client.db.init()
+        try:
+            links = Links(client)
+            return await links.get_title(
+                'https://en.wikipedia.org/wiki/Python_(programming_language)'
+            )
+        finally:
+            await client.close()
+
+    assert asyncio.run(main()) == \
+        'Python (programming language) - Wikipedia'
@@ -0,0 +1,150 @@
+import asyncio
+import logging
+import configparser
+
+from billfred.database import Database
+from billfred.scheduler import Scheduler
+
+
+class Client:
+    def __init__(self, config):
+        self.config = configparser.ConfigParser()
+        self.config.read_dict({'scheduler': config})
+
+
+def test_deferred_jobs_are_capped(caplog):
+    done = []
+
+    async def job(i):
+        await asyncio.sleep(0)
+        done.append(i)
+
+    async def main():
+        scheduler = Scheduler(Client({'command_queue': '2',
+                                      'command_policy': 'defer',
+                                      'command_overflow': '3'}))
+        scheduler.start()
+        accepted = [scheduler.submit('command', job, i) for i in range(10)]
+        await scheduler.close()
+        return accepted, scheduler.queues['command'].stats
+
+    with caplog.at_level(logging.ERROR):
+        accepted, stats = asyncio.run(main())
+    assert accepted == [True] * 5 + [False] * 5
+    assert done == [0, 1, 2, 3, 4]
+    assert stats['dropped'] == 5
+    # Full overflow is reported once
+    assert len([r for r in caplog.records
+                if 'Overflow of command queue is full' in r.message]) == 1
+
+
+def test_log_jobs_are_never_dropped(caplog):
+    done = []
+
+    async def job(i):
+        await asyncio.sleep(0)
+        done.append(i)
+
+    async def main():
+        scheduler = Scheduler(Client({'log_queue': '2',
+                                      'log_policy': 'drop_new',
+                                      'log_overflow': '3'}))
+        scheduler.start()
+        accepted = [scheduler.submit('log', job, i) for i in range(10)]
+        await scheduler.close()
+        return accepted, scheduler.queues['log']
+
+    with caplog.at_level(logging.WARNING):
+        accepted, queue = asyncio.run(main())
+    assert queue.policy == 'defer'
+    assert accepted == [True] * 10
+    assert done == list(range(10))
+    assert queue.stats['dropped'] == 0
+    assert len([r for r in caplog.records
+                if 'Overflow of log queue has' in r.message]) == 1
+
+
+def test_close_waits_for_running_log_write(tmp_path):
+    async def main():
+        db = Database(str(tmp_path / 'test.db'), {'queue_size': '1',
+                                                  'batch_size': '1'})
+        await db.init()
+        flush = db.flush
+
+        async def slow_flush(batch):
+            await asyncio.sleep(0.05)
+            await flush(batch)
+        db.flush = slow_flush
+        scheduler = Scheduler(Client({}))
+        scheduler.start()
+        for i in range(3):
+            message = {'from': 'room@conference', 'mucnick': 'nick',
+                       'body': str(i)}
+            scheduler.submit('log', db.write_row, db.log_row(message))
+        # Writer is flushing, worker is blocked on full database queue
+        await asyncio.sleep(0.01)
+        await scheduler.close()
+        await db.close()
+        async with db.reader() as conn:
+            async with conn.execute(
+                    r'SELECT message FROM chat_log ORDER BY id') as cursor:
+                return await cursor.fetchall()
+
+    assert asyncio.run(main()) == [('0',), ('1',), ('2',)]
+
+
+def test_full_queues_drop_by_policy():
+    done = []
+
+    async def job(kind, i):
+        done.append((kind, i))
+
+    async def main():
+        scheduler = Scheduler(Client({'links_queue': '2',
+                                      'command_queue': '2'}))
+        for i in range(4):
+            scheduler.submit('links', job, 'links', i)
+            scheduler.submit('command', job, 'command', i)
+        scheduler.start()
+        await asyncio.sleep(0.01)
+        await scheduler.close()
+
+    asyncio.run(main())
+    assert sorted(done) == [('command', 0), ('command', 1),
+                            ('links', 2), ('links', 3)]
+
+
+def test_nick_is_rate_limited():
+    async def job():
+        pass
+
+    async def main():
+        scheduler = Scheduler(Client({'nick_rate': '0.001',
+                                      'nick_burst': '2'}))
+        results = [scheduler.submit('command', job, nick='flooder')
+                   for _ in range(3)]
+        results.append(scheduler.submit('command', job, nick='other'))
+        await scheduler.close()
+        return results
+
+    assert asyncio.run(main()) == [True, True, False, True]
+
+
+def test_deferred_log_write_keeps_message_time(tmp_path):
+    async def main():
+        db = Database(str(tmp_path / 'test.db'))
+        await db.init()
+        scheduler = Scheduler(Client({}))
+        message = {'from': 'room@conference', 'mucnick': 'nick',
+                   'body': 'hello'}
+        # Job waits in queue until workers start
+        scheduler.submit('log', db.write_row, db.log_row(message, 1000.0))
+        await asyncio.sleep(0.01)
+        scheduler.start()
+        await scheduler.close()
+        await db.close()
+        async with db.reader() as conn:
+            async with conn.execute(r'SELECT time FROM chat_log') as cursor:
+                return await cursor.fetchall()
+
+    assert asyncio.run(main()) == [(1000,)]
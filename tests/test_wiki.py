@@ -0,0 +1,117 @@
+import time
+import asyncio
+
+from aiohttp import web
+
+from billfred.wiki import Wiki
+from helpers import Client, stub_server
+
+LATENCY = 0.05
+
+
+def pages(request):
+    """Search results in generator=search format, reversed index order."""
+    lang = request.match_info['lang']
+    return [{
+        'pageid': i,
+        'title': 'Article {}'.format(i),
+        'index': 3 - i,
+        'extract': 'Intro of article {}. '.format(i) * 30,
+        'fullurl': 'https://{}.example/wiki/Article_{}'.format(lang, i),
+    } for i in range(3)]
+
+
+def run_wiki(tmp_path, handler, func):
+    """Run func(wiki, client) with wiki pointed at stub API."""
+    async def main():
+        async with stub_server({'/{lang}/w/api.php': handler}) as base:
+            client = Client(tmp_path / 'test.db', {'wiki': {
+                'base_url': base + '/{lang}',
+                'lang_concurrency': '2',
+            }})
+            await client.db.init()
+            try:
+                return await func(Wiki(client), client)
+            finally:
+                await client.close()
+    return asyncio.run(main())
+
+
+def test_search_answers_with_extracts_in_one_request(tmp_path):
+    requests = []
+
+    async def api(request):
+        requests.append(dict(request.query))
+        if request.query['gsrsearch'] == 'nothing':
+            return web.json_response({'batchcomplete': True})
+        return web.json_response({'query': {'pages': pages(request)}})
+
+    async def search(wiki, client):
+        await wiki.search('cats', 'en', False)
+        await wiki.search('nothing', 'en', False)
+        # Cached answer doesn't make request
+        await wiki.search('Cats ', 'en', False)
+        return [m['message'] for m in client.sent]
+
+    sent = run_wiki(tmp_path, api, search)
+    assert len(requests) == 2
+    assert requests[0]['generator'] == 'search'
+    assert requests[0]['prop'] == 'extracts|info'
+    results = sent[0].split('\n\n')
+    assert [r.split(' - ')[0] for r in results] == [
+        'https://en.example/wiki/Article_2',
+        'https://en.example/wiki/Article_1',
+        'https://en.example/wiki/Article_0',
+    ]
+    assert all(len(r.split(': ', 1)[1]) <= Wiki.EXTRACT_LENGTH + 3
+               for r in results)
+    assert sent[1] == 'Nothing found, sorry'
+    assert sent[2] == sent[0]
+
+
+def test_errors_are_not_cached(tmp_path):
+    requests = []
+
+    async def api(request):
+        requests.append(request.query['gsrsearch'])
+        if len(requests) == 1:
+            return web.json_response({'error': {'code': 'internal'}})
+        return web.json_response({'query': {'pages': pages(request)}})
+
+    async def search(wiki, client):
+        await wiki.search('cats', 'en', False)
+        await wiki.search('cats', 'en', False)
+        return [m['message'] for m in client.sent]
+
+    sent = run_wiki(tmp_path, api, search)
+    assert len(requests) == 2
+    assert sent[0] == 'Search error'
+    assert sent[1].startswith('https://en.example/wiki/Article_2')
+
+
+def test_languages_have_separate_budgets(tmp_path):
+    active = {}
+    peak = {}
+
+    async def api(request):
+        lang = request.match_info['lang']
+        active[lang] = active.get(lang, 0) + 1
+        peak[lang] = max(peak.get(lang, 0), active[lang])
+        await asyncio.sleep(LATENCY)
+        active[lang] -= 1
+        return web.json_response({'query': {'pages': pages(request)}})
+
+    async def search(wiki, client):
+        start = time.perf_counter()
+        await asyncio.gather(
+            *[wiki.fetch('en{}'.format(i), 'q{}'.format(i), 'en', False)
+              for i in range(6)],
+            *[wiki.fetch('de{}'.format(i), 'q{}'.format(i), 'de', False)
+              for i in range(2)],
+        )
+        return time.perf_counter() - start
+
+    elapsed = run_wiki(tmp_path, api, search)
+    assert peak == {'en': 2, 'de': 2}
+    # Three rounds of two en requests, de requests run alongside
+    assert elapsed < LATENCY * 5
@@ -0,0 +1,27 @@
+import pytest
+
+from billfred.wikiindex import TitleIndex, build_index
+
+TITLES = ['Python', 'Python (programming language)', 'Pythonidae', 'Perl']
+
+
+def test_lookup_finds_exact_and_prefix_matches(tmp_path):
+    path = str(tmp_path / 'en.idx')
+    assert build_index(TITLES, path, chunk_size=2) == 4
+    index = TitleIndex(path)
+    try:
+        assert index.lookup('python', 3) == TITLES[:3]
+        assert index.lookup('perl', 3) == ['Perl']
+        assert index.lookup('ruby', 3) == []
+    finally:
+        index.close()
+
+
+@pytest.mark.parametrize('size', [0, 10, 20])
+def test_truncated_index_raises_value_error(tmp_path, size):
+    path = str(tmp_path / 'en.idx')
+    build_index(TITLES, path)
+    with open(path, 'r+b') as f:
+        f.truncate(size)
+    with pytest.raises(ValueError):
+        TitleIndex(path)